@@ -0,0 +1,177 @@
+import csv
+import io
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# Usage statistics built from the machine event history. Each use is paired with the
+# collection that followed it into a session, and the sessions are aggregated with
+# NumPy, so a year of history takes well under a second.
+
+WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+SPARK = "▁▂▃▄▅▆▇█"
+
+def _to_seconds(values: List[str]) -> np.ndarray:
+    """Convert ISO timestamps (local time, without a timezone) to seconds."""
+    return np.array(values, dtype='datetime64[us]').astype('datetime64[s]').astype(np.int64)
+
+def build_sessions(events: List[Dict]) -> Dict[str, np.ndarray]:
+    """
+    Pair each 'use' event with the 'collect' (or 'expire') that followed it on the same machine.
+    Returns arrays: machine_id, user_id, username, start, planned_end and collected (in
+    seconds; collected is -1 for machines still in use).
+    """
+    uses = []
+    collected = []
+    open_uses = {}
+    for event in events:
+        if event['event'] == 'use':
+            open_uses[event['machine_id']] = len(uses)
+            uses.append(event)
+            collected.append('')
+        elif event['event'] in ('collect', 'expire'):
+            index = open_uses.pop(event['machine_id'], None)
+            if index is not None:
+                collected[index] = event['time']
+
+    done = np.array([bool(time) for time in collected], dtype=bool)
+    collected_seconds = np.full(len(uses), -1, dtype=np.int64)
+    if done.any():
+        collected_seconds[done] = _to_seconds([time for time in collected if time])
+
+    return {
+        'machine_id': np.array([use['machine_id'] for use in uses], dtype=object),
+        'user_id': np.array([use['user_id'] for use in uses], dtype=object),
+        'username': np.array([use['username'] for use in uses], dtype=object),
+        'start': _to_seconds([use['time'] for use in uses]),
+        'planned_end': _to_seconds([use['end_time'] for use in uses]),
+        'collected': collected_seconds,
+    }
+
+def _now_seconds(now: Optional[datetime] = None) -> int:
+    return int(np.datetime64(now or datetime.now(), 's').astype(np.int64))
+
+def _occupied_until(sessions: Dict[str, np.ndarray], now: int) -> np.ndarray:
+    """When each session's machine became free again (now, if it is still in use)."""
+    end = np.where(sessions['collected'] >= 0, sessions['collected'], now)
+    return np.maximum(end, sessions['start'] + 1)
+
+def occupancy_heatmap(sessions: Dict[str, np.ndarray], now: Optional[datetime] = None) -> np.ndarray:
+    """
+    Average number of machines in use for each weekday and hour, as a 7 x 24 array
+    (Monday first), over the time since the first session.
+    """
+    heatmap = np.zeros((7, 24))
+    if not len(sessions['start']):
+        return heatmap
+    now = _now_seconds(now)
+    start = sessions['start']
+    end = _occupied_until(sessions, now)
+
+    # Split every session into the hours it covers
+    first_hour = start // 3600
+    spans = (end - 1) // 3600 - first_hour + 1
+    offsets = np.arange(spans.sum()) - np.repeat(np.cumsum(spans) - spans, spans)
+    hours = np.repeat(first_hour, spans) + offsets
+    busy = (np.minimum(np.repeat(end, spans), (hours + 1) * 3600)
+            - np.maximum(np.repeat(start, spans), hours * 3600))
+
+    # 1970-01-01 was a Thursday
+    slots = ((hours // 24 + 3) % 7) * 24 + hours % 24
+    busy_seconds = np.bincount(slots, weights=busy, minlength=168)
+
+    # How many times each weekday/hour occurred over the period
+    all_hours = np.arange(start.min() // 3600, now // 3600 + 1)
+    occurrences = np.bincount(((all_hours // 24 + 3) % 7) * 24 + all_hours % 24, minlength=168)
+
+    heatmap = busy_seconds / np.maximum(occurrences, 1) / 3600
+    return heatmap.reshape(7, 24)
+
+def overrun_minutes(sessions: Dict[str, np.ndarray]) -> Dict[str, float]:
+    """How long laundry sat in the machine after it finished, over collected sessions."""
+    done = sessions['collected'] >= 0
+    overrun = np.maximum(sessions['collected'][done] - sessions['planned_end'][done], 0) / 60
+    if not len(overrun):
+        return {'count': 0, 'mean': 0.0, 'median': 0.0, 'p90': 0.0}
+    return {
+        'count': int(len(overrun)),
+        'mean': float(overrun.mean()),
+        'median': float(np.median(overrun)),
+        'p90': float(np.percentile(overrun, 90)),
+    }
+
+def utilisation(sessions: Dict[str, np.ndarray], now: Optional[datetime] = None) -> Dict[str, float]:
+    """Fraction of the time since the first session that each machine was in use."""
+    if not len(sessions['start']):
+        return {}
+    now = _now_seconds(now)
+    machine_ids, index = np.unique(sessions['machine_id'].astype(str), return_inverse=True)
+    busy = np.bincount(index, weights=_occupied_until(sessions, now) - sessions['start'])
+    period = max(now - int(sessions['start'].min()), 1)
+    return {machine_id: float(value) for machine_id, value in zip(machine_ids, busy / period)}
+
+def format_report(sessions: Dict[str, np.ndarray], now: Optional[datetime] = None) -> str:
+    """Summarize usage as a short chat message."""
+    count = len(sessions['start'])
+    if not count:
+        return "📊 No machine usage recorded yet."
+
+    heatmap = occupancy_heatmap(sessions, now)
+    overrun = overrun_minutes(sessions)
+    planned = (sessions['planned_end'] - sessions['start']) / 60
+
+    lines = ["📊 Usage report", "", f"Uses: {count}, average planned duration {planned.mean():.0f} min"]
+    if overrun['count']:
+        lines.append(f"Waiting to be collected: avg {overrun['mean']:.0f} min, "
+                     f"median {overrun['median']:.0f} min, 90% within {overrun['p90']:.0f} min")
+
+    lines += ["", "Utilisation:"]
+    for machine_id, value in utilisation(sessions, now).items():
+        lines.append(f"{machine_id}: {value:.0%}")
+
+    # Average machines in use by hour of the day, and the busiest times of the week
+    by_hour = heatmap.mean(axis=0)
+    levels = (by_hour / max(by_hour.max(), 1e-9) * (len(SPARK) - 1)).round().astype(int)
+    lines += ["", "By hour (0-23):", "".join(SPARK[level] for level in levels), "", "Busiest times:"]
+    for slot in np.argsort(heatmap, axis=None)[::-1][:5]:
+        weekday, hour = divmod(int(slot), 24)
+        if heatmap[weekday, hour] <= 0:
+            break
+        lines.append(f"{WEEKDAYS[weekday]} {hour:02d}:00  {heatmap[weekday, hour]:.1f} machines in use")
+    return "\n".join(lines)
+
+def export_sessions_csv(sessions: Dict[str, np.ndarray]) -> str:
+    """One row per use: machine, user, start, planned end, collection time and overrun."""
+    def iso(seconds):
+        return np.datetime_as_string(seconds.astype('datetime64[s]'))
+
+    done = sessions['collected'] >= 0
+    collected = np.where(done, iso(np.maximum(sessions['collected'], 0)), '')
+    overrun = np.maximum(sessions['collected'] - sessions['planned_end'], 0) / 60
+    overrun = np.where(done, np.char.mod('%.1f', overrun), '')
+
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['machine_id', 'user_id', 'username', 'start', 'planned_minutes', 'planned_end',
+                     'collected', 'overrun_minutes'])
+    writer.writerows(zip(
+        sessions['machine_id'],
+        sessions['user_id'],
+        sessions['username'],
+        iso(sessions['start']),
+        ((sessions['planned_end'] - sessions['start']) // 60).tolist(),
+        iso(sessions['planned_end']),
+        collected,
+        overrun
+    ))
+    return output.getvalue()
+
+def export_heatmap_csv(heatmap: np.ndarray) -> str:
+    """The occupancy heatmap with one row per weekday and one column per hour."""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['weekday'] + [f"{hour:02d}" for hour in range(24)])
+    for weekday, row in zip(WEEKDAYS, heatmap):
+        writer.writerow([weekday] + [f"{value:.3f}" for value in row])
+    return output.getvalue()
@@ -0,0 +1,108 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import data_manager as dm
+
+# Awaitable versions of the data_manager functions used by the bot's handlers.
+# Reads are served from data_manager's in-memory state and never touch the disk, so
+# they run directly, as do machine changes (they only update memory and queue events
+# for the write-behind flush). Anything that writes to storage (or may wait on a lock
+# held during a write) runs in a thread pool, so the event loop never does file I/O.
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="storage")
+# User writes are serialized by data_manager's user write lock, so they get their own
+# thread: a burst of /starts during a slow write can't take up the shared pool
+_user_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="user-storage")
+
+async def _run(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+
+async def _run_user_write(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(_user_executor, func, *args)
+
+async def add_user(user_id: int, username: str):
+    await _run_user_write(dm.add_user, user_id, username)
+
+async def set_subscribed(user_id: int, subscribed: bool) -> bool:
+    return await _run_user_write(dm.set_subscribed, user_id, subscribed)
+
+async def compact_users():
+    await _run_user_write(dm.compact_users)
+
+async def set_topics(user_id: int, topics: List[str]) -> bool:
+    return await _run_user_write(dm.set_topics, user_id, topics)
+
+async def set_quiet_hours(user_id: int, start_hour: Optional[int], end_hour: Optional[int]) -> bool:
+    return await _run_user_write(dm.set_quiet_hours, user_id, start_hour, end_hour)
+
+async def get_user_state(user_id: int) -> Dict:
+    return await _run(dm.get_user_state, user_id)
+
+async def save_user_states(states: Dict[int, Dict]):
+    await _run(dm.save_user_states, states)
+
+async def set_user_room(user_id: int, room_id: str) -> bool:
+    return await _run_user_write(dm.set_user_room, user_id, room_id)
+
+# Machine changes only hold a machine's own lock and never wait on the disk
+async def use_machine(room_id: str, machine_id: str, user_id: int, username: str, duration_minutes: int,
+                      expected_version: Optional[int] = None) -> Optional[str]:
+    return dm.use_machine(room_id, machine_id, user_id, username, duration_minutes, expected_version)
+
+async def collect_by_code(code: str) -> tuple[bool, str, Optional[str], Optional[str]]:
+    return dm.collect_by_code(code)
+
+async def mark_finished(room_id: str, machine_id: str, code: str) -> bool:
+    return dm.mark_finished(room_id, machine_id, code)
+
+async def release_machine(room_id: str, machine_id: str, code: str) -> Optional[Dict]:
+    return dm.release_machine(room_id, machine_id, code)
+
+async def get_machine_history(room_id: str, machine_id: Optional[str] = None,
+                              limit: Optional[int] = 20) -> List[Dict]:
+    return await _run(dm.get_machine_history, room_id, machine_id, limit)
+
+async def set_live_board(chat_id: int, message_id: int, room_id: str):
+    await _run(dm.set_live_board, chat_id, message_id, room_id)
+
+async def remove_live_board(chat_id: int) -> bool:
+    return await _run(dm.remove_live_board, chat_id)
+
+# Waitlists are kept in memory only
+async def join_waitlist(room_id: str, machine_type: str, user_id: int) -> int:
+    return dm.join_waitlist(room_id, machine_type, user_id)
+
+async def leave_waitlist(room_id: str, machine_type: str, user_id: int) -> bool:
+    return dm.leave_waitlist(room_id, machine_type, user_id)
+
+async def offer_machine(room_id: str, machine_id: str) -> Optional[int]:
+    return dm.offer_machine(room_id, machine_id)
+
+async def release_offer(room_id: str, machine_id: str, user_id: int) -> bool:
+    return dm.release_offer(room_id, machine_id, user_id)
+
+async def get_user(user_id: int) -> Optional[Dict]:
+    return dm.get_user(user_id)
+
+async def get_user_room(user_id: int) -> str:
+    return dm.get_user_room(user_id)
+
+async def get_all_machines(room_id: str) -> List[Dict]:
+    return dm.get_all_machines(room_id)
+
+async def get_machine_by_id(room_id: str, machine_id: str) -> Optional[Dict]:
+    return dm.get_machine_by_id(room_id, machine_id)
+
+async def get_machine_version(room_id: str, machine_id: str) -> Optional[int]:
+    return dm.get_machine_version(room_id, machine_id)
+
+async def next_free_time(room_id: str, machine_type: str, position: int = 1) -> Optional[tuple]:
+    return dm.next_free_time(room_id, machine_type, position)
+
+async def get_status_message(room_id: str) -> str:
+    return dm.get_status_message(room_id)
+
+def shutdown():
+    """Wait for in-flight storage calls to finish."""
+    _user_executor.shutdown(wait=True)
+    _executor.shutdown(wait=True)
@@ -0,0 +1,263 @@
+"""
+Load test for the bot's handlers, using fake Telegram objects (no network).
+
+Simulates N residents concurrently doing /start, status, reserve and collect flows,
+spread over one or more laundry rooms, and reports throughput and latency percentiles per handler and per data_manager
+operation. Results can be saved as JSON to compare versions.
+
+Usage:
+    python benchmark.py --users 200 --rounds 5 --output bench.json
+    python benchmark.py --users 2000 --rooms 200
+"""
+import argparse
+import asyncio
+import csv
+import itertools
+import json
+import os
+import random
+import re
+import tempfile
+import time
+from collections import defaultdict
+from functools import wraps
+from types import SimpleNamespace
+
+import bot
+import broadcaster
+import data_manager as dm
+import ratelimit
+import timers
+
+# Operation name -> list of latencies in seconds
+_timings = defaultdict(list)
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def summarize(timings, elapsed):
+    results = {}
+    for name, values in sorted(timings.items()):
+        values = sorted(values)
+        results[name] = {
+            'count': len(values),
+            'throughput_per_s': len(values) / elapsed if elapsed else 0.0,
+            'p50_ms': percentile(values, 50) * 1000,
+            'p95_ms': percentile(values, 95) * 1000,
+            'p99_ms': percentile(values, 99) * 1000,
+            'max_ms': values[-1] * 1000 if values else 0.0,
+        }
+    return results
+
+def timed(name, func):
+    """Wrap a sync or async function to record its latency under name."""
+    if asyncio.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                _timings[name].append(time.perf_counter() - start)
+        return async_wrapper
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _timings[name].append(time.perf_counter() - start)
+    return wrapper
+
+def instrument_data_manager():
+    for name in ['add_user', 'get_all_machines', 'get_machine_by_id', 'use_machine',
+                 'collect_machine', 'collect_by_code', 'get_status_message', 'flush_machines']:
+        setattr(dm, name, timed(f"dm.{name}", getattr(dm, name)))
+
+class FakeBot:
+    """Stands in for telegram.Bot; records outgoing messages instead of sending them."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.sent = 0
+        self.edited = 0
+        self._message_ids = itertools.count(1)
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sent += 1
+        return FakeMessage(self, chat_id, text, reply_markup)
+
+    async def edit_message_text(self, message, text, reply_markup=None, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.edited += 1
+        message.text = text
+        message.reply_markup = reply_markup
+        return message
+
+class FakeMessage:
+    def __init__(self, fake_bot: FakeBot, chat_id: int, text: str = "", reply_markup=None):
+        self.bot = fake_bot
+        self.chat_id = chat_id
+        self.message_id = next(fake_bot._message_ids)
+        self.text = text
+        self.reply_markup = reply_markup
+        self.replies = []
+
+    async def reply_text(self, text, reply_markup=None, **kwargs):
+        reply = await self.bot.send_message(self.chat_id, text, reply_markup=reply_markup, **kwargs)
+        self.replies.append(reply)
+        return reply
+
+class Resident:
+    """One simulated user with their own chat and user_data."""
+
+    def __init__(self, user_id: int, fake_bot: FakeBot, room_id: str):
+        self.user = SimpleNamespace(id=user_id, username=f"user{user_id}", first_name=f"User {user_id}")
+        self.bot = fake_bot
+        self.room_id = room_id
+        self.context = SimpleNamespace(bot=fake_bot, user_data={}, args=[])
+        self.message = FakeMessage(fake_bot, user_id)
+
+    async def command(self, handler, args=()):
+        message = FakeMessage(self.bot, self.user.id, "/start")
+        update = SimpleNamespace(effective_user=self.user, message=message, callback_query=None)
+        self.context.args = list(args)
+        await handler(update, self.context)
+        if message.replies:
+            self.message = message.replies[-1]
+        return self.message
+
+    async def text(self, text):
+        message = FakeMessage(self.bot, self.user.id, text)
+        update = SimpleNamespace(effective_user=self.user, message=message, callback_query=None)
+        await bot.handle_code_message(update, self.context)
+        if message.replies:
+            self.message = message.replies[-1]
+        return self.message
+
+    async def tap(self, data):
+        """Press a button on the latest message; returns the message shown afterwards."""
+        message = self.message
+
+        async def answer(*args, **kwargs):
+            pass
+
+        async def edit_message_text(text, reply_markup=None, **kwargs):
+            return await self.bot.edit_message_text(message, text, reply_markup=reply_markup, **kwargs)
+
+        query = SimpleNamespace(data=data, from_user=self.user, message=message, answer=answer,
+                                edit_message_text=edit_message_text, get_bot=lambda: self.bot)
+        update = SimpleNamespace(effective_user=self.user, callback_query=query, message=None)
+        replies_before = len(message.replies)
+        await bot.button_handler(update, self.context)
+        if len(message.replies) > replies_before:
+            self.message = message.replies[-1]
+        return self.message
+
+def free_machine_buttons(reply):
+    if reply is None or reply.reply_markup is None:
+        return []
+    return [button.callback_data for row in reply.reply_markup.inline_keyboard for button in row
+            if button.callback_data and button.callback_data.startswith("machine_")]
+
+async def resident_flow(resident: Resident, rounds: int):
+    # Joins their room through a /start deep link
+    await resident.command(bot.start, [resident.room_id])
+    for _ in range(rounds):
+        await resident.tap("status")
+        await resident.tap("use_machine")
+        reply = await resident.tap(random.choice(["washing_machines", "dryers"]))
+        choices = free_machine_buttons(reply)
+        if not choices:
+            continue
+
+        machine_id = random.choice(choices).split("_")[1]
+        reply = await resident.tap(f"machine_{machine_id}")
+        time_button = reply.reply_markup.inline_keyboard[0][0].callback_data
+        reply = await resident.tap(time_button)
+
+        match = re.search(r"collection code: `(\w+)`", reply.text if reply else "")
+        if match:
+            await resident.tap("status")
+            await resident.text(match.group(1))
+
+async def run(users: int, rounds: int, latency: float):
+    fake_bot = FakeBot(latency)
+    room_ids = list(dm.get_rooms())
+    residents = [Resident(100000 + i, fake_bot, room_ids[i % len(room_ids)]) for i in range(users)]
+
+    start = time.perf_counter()
+    await asyncio.gather(*(resident_flow(r, rounds) for r in residents))
+    # Send queued notifications and let background broadcasts finish, so their messages are counted
+    await broadcaster.drain(timeout=None)
+    elapsed = time.perf_counter() - start
+    return elapsed, fake_bot.sent, fake_bot.edited, timers.pending()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100, help="number of simulated residents")
+    parser.add_argument('--rounds', type=int, default=3, help="reserve/collect flows per resident")
+    parser.add_argument('--rooms', type=int, default=1, help="number of laundry rooms the residents are spread over")
+    parser.add_argument('--backend', default='csv', choices=['csv', 'sqlite'])
+    parser.add_argument('--latency-ms', type=float, default=0.0, help="simulated Telegram API latency")
+    parser.add_argument('--telegram-limits', action='store_true',
+                        help="keep Telegram's broadcast rate limits and the per-user limits "
+                             "(by default they are lifted for the fake bot)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write results to this JSON file")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    if not args.telegram_limits:
+        broadcaster._global_bucket = broadcaster.TokenBucket(1e9, 1e9)
+        broadcaster.PER_CHAT_RATE = 1e9
+        ratelimit._user_buckets = ratelimit.BucketTable(1e9, 1e9)
+        ratelimit.DUPLICATE_WINDOW = 0
+    output = os.path.abspath(args.output) if args.output else None
+
+    # Run against fresh data files in a scratch directory
+    os.chdir(tempfile.mkdtemp(prefix="laundry-bench-"))
+    if args.rooms > 1:
+        with open(dm.ROOMS_FILE, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['room_id', 'name', 'washing_machines', 'dryers'])
+            for i in range(1, args.rooms + 1):
+                writer.writerow([f"room-{i}", f"Room {i}", dm.WASHING_MACHINES, dm.DRYERS])
+    dm.init_storage(args.backend)
+    instrument_data_manager()
+    for name in ['start', 'button_handler', 'handle_code_message']:
+        setattr(bot, name, timed(f"handler.{name}", getattr(bot, name)))
+
+    elapsed, sent, edited, pending_timers = asyncio.run(run(args.users, args.rounds, args.latency_ms / 1000))
+    dm.close_storage()
+
+    results = {
+        'config': vars(args),
+        'elapsed_s': elapsed,
+        'messages_sent': sent,
+        'messages_edited': edited,
+        'timers_pending': pending_timers,
+        'operations': summarize(_timings, elapsed),
+    }
+
+    print(f"{args.users} users x {args.rounds} rounds in {elapsed:.2f}s, "
+          f"{sent} messages sent, {edited} edited, {pending_timers} timers pending\n")
+    print(f"{'operation':<28}{'count':>8}{'ops/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, stats in results['operations'].items():
+        print(f"{name:<28}{stats['count']:>8}{stats['throughput_per_s']:>10.0f}"
+              f"{stats['p50_ms']:>10.3f}{stats['p95_ms']:>10.3f}{stats['p99_ms']:>10.3f}")
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults saved to {output}")
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,16 @@
+import asyncio
+import io
 import os
+import re
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional, Set
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
+from telegram.helpers import escape_markdown
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -11,93 +21,234 @@ from telegram.ext import (
     filters
 )
 
+import analytics
+import broadcaster
+import async_data_manager as adm
 import data_manager as dm
+import live_status
+import metrics
+import ratelimit
+import timers
+from persistence import UserStatePersistence
 
 # Load environment variables
 load_dotenv()
 BOT_TOKEN = os.getenv('BOT_TOKEN')
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'csv')
+METRICS_PORT = os.getenv('METRICS_PORT')
+# Webhook mode is used when WEBHOOK_URL is set; otherwise the bot polls
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+# Optional chat (e.g. a channel, as @name or ID) with a shared live status board
+LIVE_STATUS_CHAT = os.getenv('LIVE_STATUS_CHAT')
+# Seconds to collect broadcast notifications before sending them as one message (0 to disable)
+broadcaster.COALESCE_WINDOW = float(os.getenv('NOTIFY_COALESCE_SECONDS', broadcaster.COALESCE_WINDOW))
+# Seconds a freed machine is held for the next user on the waitlist
+dm.CLAIM_TIMEOUT = int(os.getenv('CLAIM_TIMEOUT_SECONDS', dm.CLAIM_TIMEOUT))
+# Minutes between "laundry not collected yet" reminders after a machine finishes: the
+# first is sent this long after the finish notification, each next one after the previous
+REMINDER_MINUTES = [int(m) for m in os.getenv('REMINDER_MINUTES', '15,30,60').split(',') if m.strip()]
+# Minutes after finishing that an uncollected machine is released for others (0 = never)
+AUTO_RELEASE_MINUTES = int(os.getenv('AUTO_RELEASE_MINUTES', '180'))
+# Seconds between rewrites of users.csv without the rows that later ones replaced
+USERS_COMPACT_INTERVAL = 24 * 60 * 60
+ADMIN_IDS = {int(user_id) for user_id in os.getenv('ADMIN_IDS', '').split(',') if user_id.strip()}
 
-# Conversation states
+# Conversation states, kept in user_data['state'] so they survive restarts (see persistence.py)
 WAITING_FOR_CODE = 1
+WAITING_FOR_CUSTOM_TIME = 2
+
+# Text that is taken as a collection code even when the user didn't press "Collect Laundry"
+CODE_PATTERN = re.compile(r'[A-Z0-9]{6}')
+
+# The only update types we handle: commands and text messages, and button presses
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
 
 # Time options (in minutes)
 WASHING_MACHINE_TIMES = [40, 43, 60]
 DRYER_TIMES = [45, 55, 65]
 
+MACHINE_TYPE_NAMES = {'washing_machine': "washing machine", 'dryer': "dryer"}
+
+# Rooms are offered as buttons up to this many; beyond that users pick one with /room <id>
+ROOM_BUTTONS_LIMIT = 50
+
+# (room_id, machine_type) -> (state version, keyboard)
+_keyboard_cache = {}
+
+# (chat_id, message_id) -> (text, keyboard) last shown there, to skip edits that change nothing
+_shown_messages = OrderedDict()
+SHOWN_MESSAGES_LIMIT = 10000
+
+# Timer callbacks still running, kept so they aren't garbage collected
+_timer_tasks: Set[asyncio.Task] = set()
+
+@metrics.track_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a welcome message and show main menu."""
     user = update.effective_user
     
     # Add user to database
-    dm.add_user(user.id, user.username)
+    await adm.add_user(user.id, user.username)
     
-    keyboard = [
-        [InlineKeyboardButton("📊 Status", callback_data="status")],
-        [InlineKeyboardButton("🔧 Use a Machine", callback_data="use_machine")],
-        [InlineKeyboardButton("✅ Collect Laundry", callback_data="collect")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # A link like t.me/<bot>?start=<room_id> puts the user in that room
+    if context.args and context.args[0] in dm.get_rooms():
+        await adm.set_user_room(user.id, context.args[0])
+    
+    # Users who blocked the bot were unsubscribed; tell them how to get notifications again
+    if (await adm.get_user(user.id))['subscribed'] == 'yes':
+        notifications_line = "Use /notify to choose which machines you hear about.\n\n"
+    else:
+        notifications_line = "🔕 Notifications are off. Send /subscribe to turn them on.\n\n"
     
     await update.message.reply_text(
         f"👋 Hello {user.first_name}!\n\n"
-        "Welcome to the Laundry Room Manager Bot 🧺\n\n"
+        "Welcome to the Laundry Room Manager Bot 🧺\n"
+        f"{room_line(await adm.get_user_room(user.id))}"
+        f"{notifications_line}"
         "What would you like to do?",
-        reply_markup=reply_markup
+        reply_markup=main_menu_markup()
     )
 
+def room_line(room_id: str, markdown: bool = False) -> str:
+    """A line naming the user's room, if there is more than one (escaped for Markdown messages if asked)."""
+    if len(dm.get_rooms()) < 2:
+        return ""
+    name = dm.get_room_name(room_id)
+    return f"📍 Room: {escape_markdown(name) if markdown else name}\n"
+
+def main_menu_markup() -> InlineKeyboardMarkup:
+    keyboard = [
+        [InlineKeyboardButton("📊 Status", callback_data="status")],
+        [InlineKeyboardButton("🔧 Use a Machine", callback_data="use_machine")],
+        [InlineKeyboardButton("✅ Collect Laundry", callback_data="collect")]
+    ]
+    if len(dm.get_rooms()) > 1:
+        keyboard.append([InlineKeyboardButton("📍 Change Room", callback_data="rooms")])
+    return InlineKeyboardMarkup(keyboard)
+
+@metrics.track_handler
+@ratelimit.limit_user
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle button presses."""
     query = update.callback_query
     await query.answer()
     
     data = query.data
+    # Machine buttons refer to machines in the user's room
+    room_id = await adm.get_user_room(query.from_user.id)
+    
+    # Any other button leaves a flow that was waiting for typed input
+    if data != "collect" and not data.startswith("custom_"):
+        clear_state(context.user_data)
     
     if data == "status":
-        await show_status(query)
+        await show_status(query, room_id)
     
     elif data == "use_machine":
         await show_machine_types(query)
     
     elif data == "washing_machines":
-        await show_washing_machines(query)
+        await show_washing_machines(query, room_id)
     
     elif data == "dryers":
-        await show_dryers(query)
+        await show_dryers(query, room_id)
     
     elif data.startswith("machine_"):
         # Format: machine_WM1 or machine_D1
         machine_id = data.split("_")[1]
-        await show_time_options(query, machine_id)
+        await show_time_options(query, room_id, machine_id)
+    
+    elif data.startswith("waitlist_"):
+        # Format: waitlist_washing_machine or waitlist_dryer
+        await join_waitlist(query, room_id, data[len("waitlist_"):])
+    
+    elif data.startswith("leave_waitlist_"):
+        await leave_waitlist(query, room_id, data[len("leave_waitlist_"):])
+    
+    elif data.startswith("pass_"):
+        # Format: pass_WM1 (a machine held for this user from the waitlist)
+        machine_id = data.split("_")[1]
+        await pass_offer(query, room_id, machine_id, context)
     
     elif data.startswith("time_"):
-        # Format: time_WM1_40
+        # Format: time_WM1_40_<machine version>
         parts = data.split("_")
         machine_id = parts[1]
         duration = int(parts[2])
-        await start_machine(query, machine_id, duration, context)
+        version = int(parts[3]) if len(parts) > 3 else None
+        await start_machine(query, room_id, machine_id, duration, context, version)
     
     elif data.startswith("custom_"):
-        # Format: custom_WM1
-        machine_id = data.split("_")[1]
-        await request_custom_time(query, machine_id, context)
+        # Format: custom_WM1_<machine version>
+        parts = data.split("_")
+        version = int(parts[2]) if len(parts) > 2 else None
+        await request_custom_time(query, parts[1], context, version)
     
     elif data == "collect":
-        await start_collect(query)
+        await start_collect(query, context)
+    
+    elif data == "rooms":
+        await show_rooms(query, room_id)
+    
+    elif data.startswith("room_"):
+        # Format: room_<room_id>
+        await choose_room(query, data[len("room_"):])
     
     elif data == "back_to_main":
-        await back_to_main(query)
+        await back_to_main(query, room_id)
+    
+    elif data == "new_main":
+        # Leave the message this was pressed on (it has a collection code) untouched
+        await back_to_main(query, room_id, new_message=True)
     
     elif data == "back_to_machines":
         await show_machine_types(query)
 
-async def show_status(query):
-    """Show the status of all machines."""
-    status_message = dm.get_status_message()
+async def show_in_place(query, text: str, reply_markup=None, parse_mode=None):
+    """Show a screen by editing the message whose button was pressed, sending a new message if it can't be edited."""
+    message = query.message
+    if message is None or not getattr(message, 'is_accessible', True):
+        await query.get_bot().send_message(
+            chat_id=query.from_user.id,
+            text=text,
+            reply_markup=reply_markup,
+            parse_mode=parse_mode
+        )
+        return
+    
+    key = (message.chat_id, message.message_id)
+    if _shown_messages.get(key) == (text, reply_markup):
+        return
+    
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            # Too old to edit, or not a text message
+            await message.reply_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+            return
+    else:
+        # Pressing the same button on the new screen is a new press, not a repeat
+        ratelimit.message_changed(query.from_user.id, message.message_id)
+    
+    _shown_messages[key] = (text, reply_markup)
+    _shown_messages.move_to_end(key)
+    if len(_shown_messages) > SHOWN_MESSAGES_LIMIT:
+        _shown_messages.popitem(last=False)
+
+async def show_status(query, room_id: str):
+    """Show the status of all machines in the user's room."""
+    status_message = await adm.get_status_message(room_id)
     
     keyboard = [[InlineKeyboardButton("🔙 Back to Menu", callback_data="back_to_main")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await query.message.reply_text(
+    await show_in_place(
+        query,
         status_message,
         reply_markup=reply_markup,
         parse_mode='Markdown'
@@ -112,62 +263,119 @@ async def show_machine_types(query):
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await query.message.reply_text(
+    await show_in_place(
+        query,
         "Select machine type:",
         reply_markup=reply_markup
     )
 
-async def show_washing_machines(query):
-    """Show available washing machines."""
-    machines = dm.get_all_machines()
-    washing_machines = [m for m in machines if m['machine_type'] == 'washing_machine']
+def build_machine_keyboard(room_id: str, machine_type: str) -> InlineKeyboardMarkup:
+    """Build the machine selection keyboard for a machine type in a room (cached until the room changes)."""
+    version = dm.get_state_version(room_id)
+    cached = _keyboard_cache.get((room_id, machine_type))
+    if cached and cached[0] == version:
+        return cached[1]
+    
+    machines = [m for m in dm.get_all_machines(room_id) if m['machine_type'] == machine_type]
     
     keyboard = []
-    for machine in washing_machines:
+    any_free = False
+    for machine in machines:
         status_emoji = "✅" if machine['status'] == 'free' else "⏳"
         button_text = f"{status_emoji} {machine['machine_id']}"
         
-        if machine['status'] == 'free':
-            keyboard.append([InlineKeyboardButton(button_text, callback_data=f"machine_{machine['machine_id']}")])
-        else:
+        if machine['status'] != 'free':
             keyboard.append([InlineKeyboardButton(f"{button_text} (In Use)", callback_data="noop")])
+        elif dm.get_offer(room_id, machine['machine_id']) is not None:
+            keyboard.append([InlineKeyboardButton(f"🔒 {machine['machine_id']} (Held)", callback_data="noop")])
+        else:
+            any_free = True
+            keyboard.append([InlineKeyboardButton(button_text, callback_data=f"machine_{machine['machine_id']}")])
     
+    if not any_free:
+        keyboard.append([InlineKeyboardButton("⏳ Join Waitlist", callback_data=f"waitlist_{machine_type}")])
     keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="back_to_machines")])
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await query.message.reply_text(
+    _keyboard_cache[(room_id, machine_type)] = (version, reply_markup)
+    return reply_markup
+
+async def show_washing_machines(query, room_id: str):
+    """Show available washing machines in the user's room."""
+    reply_markup = build_machine_keyboard(room_id, 'washing_machine')
+    
+    await show_in_place(
+        query,
         "🌀 *Washing Machines*\n\nSelect a free machine:",
         reply_markup=reply_markup,
         parse_mode='Markdown'
     )
 
-async def show_dryers(query):
-    """Show available dryers."""
-    machines = dm.get_all_machines()
-    dryers = [m for m in machines if m['machine_type'] == 'dryer']
+async def show_dryers(query, room_id: str):
+    """Show available dryers in the user's room."""
+    reply_markup = build_machine_keyboard(room_id, 'dryer')
     
-    keyboard = []
-    for machine in dryers:
-        status_emoji = "✅" if machine['status'] == 'free' else "⏳"
-        button_text = f"{status_emoji} {machine['machine_id']}"
-        
-        if machine['status'] == 'free':
-            keyboard.append([InlineKeyboardButton(button_text, callback_data=f"machine_{machine['machine_id']}")])
-        else:
-            keyboard.append([InlineKeyboardButton(f"{button_text} (In Use)", callback_data="noop")])
+    await show_in_place(
+        query,
+        "🔥 *Dryers*\n\nSelect a free machine:",
+        reply_markup=reply_markup,
+        parse_mode='Markdown'
+    )
+
+async def join_waitlist(query, room_id: str, machine_type: str):
+    """Put the user on the waitlist for a machine type in their room."""
+    position = await adm.join_waitlist(room_id, machine_type, query.from_user.id)
+    name = MACHINE_TYPE_NAMES.get(machine_type, machine_type)
     
-    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="back_to_machines")])
+    expected = ""
+    next_free = await adm.next_free_time(room_id, machine_type, position)
+    if next_free and next_free[1] and next_free[0] > datetime.now():
+        expected = f"Expected: around {next_free[0].strftime('%H:%M')}\n"
+    
+    keyboard = [
+        [InlineKeyboardButton("🚪 Leave Waitlist", callback_data=f"leave_waitlist_{machine_type}")],
+        [InlineKeyboardButton("🔙 Back to Menu", callback_data="back_to_main")]
+    ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await query.message.reply_text(
-        "🔥 *Dryers*\n\nSelect a free machine:",
+    await show_in_place(
+        query,
+        f"⏳ *You're on the {name} waitlist*\n\n"
+        f"Position: {position}\n"
+        f"{expected}\n"
+        f"When a {name} is free, it will be held for you for {max(1, dm.CLAIM_TIMEOUT // 60)} minutes "
+        f"and you'll get a message to claim it.",
         reply_markup=reply_markup,
         parse_mode='Markdown'
     )
 
-async def show_time_options(query, machine_id: str):
+async def leave_waitlist(query, room_id: str, machine_type: str):
+    """Take the user off the waitlist for a machine type."""
+    await adm.leave_waitlist(room_id, machine_type, query.from_user.id)
+    
+    keyboard = [[InlineKeyboardButton("🔙 Back to Menu", callback_data="back_to_main")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    await show_in_place(query, "🚪 You have left the waitlist.", reply_markup=reply_markup)
+
+async def pass_offer(query, room_id: str, machine_id: str, context: ContextTypes.DEFAULT_TYPE):
+    """Give up a machine held for the user, offering it to the next in line."""
+    keyboard = [[InlineKeyboardButton("🔙 Back to Menu", callback_data="back_to_main")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    if await adm.release_offer(room_id, machine_id, query.from_user.id):
+        await offer_or_announce(context.bot, room_id, machine_id)
+    
+    await show_in_place(query, f"👍 {machine_id} has been passed on.", reply_markup=reply_markup)
+
+async def show_time_options(query, room_id: str, machine_id: str):
     """Show time duration options for the selected machine."""
-    machine = dm.get_machine_by_id(machine_id)
+    machine = await adm.get_machine_by_id(room_id, machine_id)
+    
+    if machine is None:
+        # A button from before the user changed rooms
+        await back_to_main(query, room_id)
+        return
     
     if machine['machine_type'] == 'washing_machine':
         times = WASHING_MACHINE_TIMES
@@ -176,29 +384,35 @@ async def show_time_options(query, machine_id: str):
         times = DRYER_TIMES
         title = f"🔥 {machine_id} - Select Duration"
     
+    # The machine as shown here: reserving fails if it changes before a time is picked
+    version = await adm.get_machine_version(room_id, machine_id)
+    
     keyboard = []
     for time in times:
-        keyboard.append([InlineKeyboardButton(f"{time} minutes", callback_data=f"time_{machine_id}_{time}")])
+        keyboard.append([InlineKeyboardButton(f"{time} minutes", callback_data=f"time_{machine_id}_{time}_{version}")])
     
     # Add custom time option
-    keyboard.append([InlineKeyboardButton("✏️ Custom Time", callback_data=f"custom_{machine_id}")])
+    keyboard.append([InlineKeyboardButton("✏️ Custom Time", callback_data=f"custom_{machine_id}_{version}")])
     keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="back_to_machines")])
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await query.message.reply_text(
+    await show_in_place(
+        query,
         title,
         reply_markup=reply_markup
     )
 
-async def request_custom_time(query, machine_id: str, context: ContextTypes.DEFAULT_TYPE):
+async def request_custom_time(query, machine_id: str, context: ContextTypes.DEFAULT_TYPE,
+                              version: Optional[int] = None):
     """Request custom time input from user."""
-    # Store machine_id in user_data
-    context.user_data['waiting_custom_time'] = machine_id
+    # The next text message is the duration
+    context.user_data.update(state=WAITING_FOR_CUSTOM_TIME, machine_id=machine_id, machine_version=version)
     
     keyboard = [[InlineKeyboardButton("🔙 Cancel", callback_data="back_to_main")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await query.message.reply_text(
+    await show_in_place(
+        query,
         f"✏️ *Custom Time for {machine_id}*\n\n"
         f"Please enter the duration in minutes (as a number).\n\n"
         f"Example: `45` or `90`",
@@ -206,40 +420,64 @@ async def request_custom_time(query, machine_id: str, context: ContextTypes.DEFA
         parse_mode='Markdown'
     )
 
-async def start_machine(query, machine_id: str, duration: int, context: ContextTypes.DEFAULT_TYPE):
-    """Start using a machine."""
+async def start_machine(query, room_id: str, machine_id: str, duration: int, context: ContextTypes.DEFAULT_TYPE,
+                        version: Optional[int] = None):
+    """Start using a machine, if it hasn't changed since version."""
     user = query.from_user
     
     # Use the machine
-    code = dm.use_machine(machine_id, user.id, user.username, duration)
+    code = await adm.use_machine(room_id, machine_id, user.id, user.username, duration, version)
     
-    keyboard = [[InlineKeyboardButton("🔙 Back to Menu", callback_data="back_to_main")]]
+    if code is None:
+        machine = await adm.get_machine_by_id(room_id, machine_id)
+        if machine and machine['status'] == 'in_use' and machine['user_id'] == str(user.id):
+            # A repeated tap after this user's own reservation: show the code again
+            end_time = datetime.fromisoformat(machine['end_time'])
+            await show_reservation(query, machine_id, machine['code'], f"⏱ Ready at {end_time.strftime('%H:%M')}")
+            return
+        
+        keyboard = [[InlineKeyboardButton("🔙 Back", callback_data="back_to_machines")]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await show_in_place(
+            query,
+            f"❌ Sorry, {machine_id} has already been taken.\n\n"
+            "Please choose another machine.",
+            reply_markup=reply_markup
+        )
+        return
+    
+    await show_reservation(query, machine_id, code, f"⏱ Duration: {duration} minutes")
+    
+    # Notify when it's finished, and remind if it isn't collected
+    schedule_machine_timers(room_id, machine_id, user.id, code, time.time() + duration * 60)
+
+async def show_reservation(query, machine_id: str, code: str, duration_line: str):
+    """Show the confirmation of a reservation, with its collection code."""
+    keyboard = [[InlineKeyboardButton("🔙 Back to Menu", callback_data="new_main")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await query.message.reply_text(
+    # "Back to Menu" opens a new message, so the code stays in the chat
+    await show_in_place(
+        query,
         f"✅ *Machine {machine_id} is now reserved for you!*\n\n"
-        f"⏱ Duration: {duration} minutes\n"
+        f"{duration_line}\n"
         f"🔑 Your collection code: `{code}`\n\n"
         f"_Please save this code. You'll need it to collect your laundry._\n\n"
         f"You'll receive a notification when it's finished!",
         reply_markup=reply_markup,
         parse_mode='Markdown'
     )
-    
-    # Schedule notification using job queue
-    context.job_queue.run_once(
-        send_machine_notification,
-        duration * 60,
-        data={'machine_id': machine_id, 'user_id': user.id},
-        name=f"notification_{machine_id}_{user.id}"
-    )
 
-async def start_collect(query):
+async def start_collect(query, context: ContextTypes.DEFAULT_TYPE):
     """Start the collection process."""
+    clear_state(context.user_data)
+    context.user_data['state'] = WAITING_FOR_CODE
+    
     keyboard = [[InlineKeyboardButton("🔙 Cancel", callback_data="back_to_main")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await query.message.reply_text(
+    await show_in_place(
+        query,
         "✅ *Collect Laundry*\n\n"
         "Please send me your 6-digit collection code.\n\n"
         "Format: `XXXXXX`",
@@ -247,14 +485,19 @@ async def start_collect(query):
         parse_mode='Markdown'
     )
 
+@metrics.track_handler
+@ratelimit.limit_user
 async def handle_code_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle code input from user or custom time."""
     text = update.message.text.strip()
     user = update.effective_user
     
+    state = context.user_data.get('state')
+    
     # Check if user is entering custom time
-    if 'waiting_custom_time' in context.user_data:
-        machine_id = context.user_data['waiting_custom_time']
+    if state == WAITING_FOR_CUSTOM_TIME:
+        machine_id = context.user_data['machine_id']
+        version = context.user_data.get('machine_version')
         
         # Try to parse as integer
         try:
@@ -269,10 +512,21 @@ async def handle_code_message(update: Update, context: ContextTypes.DEFAULT_TYPE
                 return
             
             # Clear the waiting state
-            del context.user_data['waiting_custom_time']
+            clear_state(context.user_data)
             
             # Start the machine with custom time
-            code = dm.use_machine(machine_id, user.id, user.username, duration)
+            room_id = await adm.get_user_room(user.id)
+            code = await adm.use_machine(room_id, machine_id, user.id, user.username, duration, version)
+            
+            if code is None:
+                keyboard = [[InlineKeyboardButton("🔙 Back", callback_data="back_to_machines")]]
+                reply_markup = InlineKeyboardMarkup(keyboard)
+                await update.message.reply_text(
+                    f"❌ Sorry, {machine_id} has already been taken.\n\n"
+                    "Please choose another machine.",
+                    reply_markup=reply_markup
+                )
+                return
             
             keyboard = [[InlineKeyboardButton("🔙 Back to Menu", callback_data="back_to_main")]]
             reply_markup = InlineKeyboardMarkup(keyboard)
@@ -287,13 +541,8 @@ async def handle_code_message(update: Update, context: ContextTypes.DEFAULT_TYPE
                 parse_mode='Markdown'
             )
             
-            # Schedule notification using job queue
-            context.job_queue.run_once(
-                send_machine_notification,
-                duration * 60,
-                data={'machine_id': machine_id, 'user_id': user.id},
-                name=f"notification_{machine_id}_{user.id}"
-            )
+            # Notify when it's finished, and remind if it isn't collected
+            schedule_machine_timers(room_id, machine_id, user.id, code, time.time() + duration * 60)
             return
             
         except ValueError:
@@ -309,16 +558,30 @@ async def handle_code_message(update: Update, context: ContextTypes.DEFAULT_TYPE
     code = text.upper()
     user = update.effective_user
     
-    # Find which machine has this code
-    machines = dm.get_all_machines()
-    found_machine = None
+    if state != WAITING_FOR_CODE and not CODE_PATTERN.fullmatch(code):
+        await update.message.reply_text(
+            "🤔 Sorry, I didn't understand that. What would you like to do?",
+            reply_markup=main_menu_markup()
+        )
+        return
     
-    for machine in machines:
-        if machine['code'] == code and machine['status'] == 'in_use':
-            found_machine = machine
-            break
+    # Limit guessing: a few wrong codes, then one more every few minutes
+    wait = ratelimit.code_lockout(user.id)
+    if wait:
+        keyboard = [[InlineKeyboardButton("🔙 Back to Menu", callback_data="back_to_main")]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await update.message.reply_text(
+            "🔒 Too many wrong codes.\n\n"
+            f"Please try again in {max(1, round(wait / 60))} minute(s).",
+            reply_markup=reply_markup
+        )
+        return
+    
+    # Collect whichever machine has this code, in any room
+    success, message, room_id, machine_id = await adm.collect_by_code(code)
     
-    if not found_machine:
+    if not machine_id:
+        ratelimit.code_failed(user.id)
         keyboard = [[InlineKeyboardButton("🔙 Back to Menu", callback_data="back_to_main")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
@@ -329,88 +592,501 @@ async def handle_code_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
         return
     
-    # Collect the machine
-    success, message = dm.collect_machine(found_machine['machine_id'], code)
-    
     keyboard = [[InlineKeyboardButton("🔙 Back to Menu", callback_data="back_to_main")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     if success:
+        clear_state(context.user_data)
         await update.message.reply_text(
             f"✅ {message}",
             reply_markup=reply_markup
         )
         
-        # Notify all users that machine is free
-        await notify_all_users(
-            context.bot,
-            f"🎉 Machine {found_machine['machine_id']} is now FREE!"
-        )
+        # Hand the machine to the next user on the waitlist, or tell interested users it is free
+        await offer_or_announce(context.bot, room_id, machine_id)
     else:
         await update.message.reply_text(
             f"❌ {message}",
             reply_markup=reply_markup
         )
 
-async def back_to_main(query):
+def clear_state(user_data: dict):
+    """Leave any flow that was waiting for typed input (a custom time or a collection code)."""
+    user_data.pop('state', None)
+    user_data.pop('machine_id', None)
+    user_data.pop('machine_version', None)
+
+async def back_to_main(query, room_id: str, new_message: bool = False):
     """Return to main menu."""
+    reply_markup = main_menu_markup()
+    
+    text = f"🧺 *Laundry Room Manager*\n\n{room_line(room_id, markdown=True)}What would you like to do?"
+    
+    if new_message:
+        await query.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+    else:
+        await show_in_place(query, text, reply_markup=reply_markup, parse_mode='Markdown')
+
+async def show_rooms(query, room_id: str):
+    """Let the user pick their laundry room."""
+    rooms = dm.get_rooms()
+    keyboard = []
+    if len(rooms) <= ROOM_BUTTONS_LIMIT:
+        for other_id, name in rooms.items():
+            label = f"📍 {name}" if other_id == room_id else name
+            keyboard.append([InlineKeyboardButton(label, callback_data=f"room_{other_id}")])
+        text = "📍 *Choose your laundry room:*"
+    else:
+        text = (f"📍 You are in *{escape_markdown(dm.get_room_name(room_id))}*.\n\n"
+                "To change rooms, send /room followed by the room ID from the notice in your laundry room.")
+    keyboard.append([InlineKeyboardButton("🔙 Back to Menu", callback_data="back_to_main")])
+    
+    await show_in_place(query, text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+
+async def choose_room(query, room_id: str):
+    """Move the user to another laundry room."""
+    await adm.add_user(query.from_user.id, query.from_user.username)
+    if not await adm.set_user_room(query.from_user.id, room_id):
+        room_id = await adm.get_user_room(query.from_user.id)
+    await back_to_main(query, room_id)
+
+@metrics.track_handler
+async def room(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show or change the user's laundry room (/room [room_id])."""
+    user = update.effective_user
+    await adm.add_user(user.id, user.username)
+    rooms = dm.get_rooms()
+    
+    if context.args:
+        room_id = next((r for r in rooms if r.lower() == context.args[0].lower()), None)
+        if room_id is None:
+            await update.message.reply_text(f"❌ Unknown room: {context.args[0]}")
+            return
+        await adm.set_user_room(user.id, room_id)
+        await update.message.reply_text(f"📍 Your room is now {rooms[room_id]}.", reply_markup=main_menu_markup())
+        return
+    
+    room_id = await adm.get_user_room(user.id)
+    keyboard = []
+    if len(rooms) <= ROOM_BUTTONS_LIMIT:
+        keyboard = [[InlineKeyboardButton(name, callback_data=f"room_{other_id}")] for other_id, name in rooms.items()]
+    await update.message.reply_text(
+        f"📍 Your room: {rooms[room_id]}\n\n"
+        "Change it with /room <room ID>" + (" or pick one below." if keyboard else "."),
+        reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None
+    )
+
+def schedule_machine_timers(room_id: str, machine_id: str, user_id: int, code: str, end_time: float,
+                            finished_at: Optional[float] = None):
+    """
+    Set the timers of a reservation: the finish notification and the release if it is
+    never collected. If the user was already told it finished (at finished_at), the
+    reminder that is next due is set instead of the finish notification.
+    """
+    group = (room_id, machine_id)
+    data = {'room_id': room_id, 'machine_id': machine_id, 'user_id': user_id, 'code': code, 'end_time': end_time}
+    if finished_at is None:
+        timers.schedule(group, 'finish', end_time, machine_finished, data)
+    else:
+        due = finished_at
+        for index, minutes in enumerate(REMINDER_MINUTES):
+            due += minutes * 60
+            if due > time.time():
+                timers.schedule(group, 'reminder', due, send_reminder, dict(data, reminder=index))
+                break
+    if AUTO_RELEASE_MINUTES > 0:
+        timers.schedule(group, 'release', end_time + AUTO_RELEASE_MINUTES * 60, release_abandoned, data)
+
+async def still_reserved(data: dict) -> Optional[dict]:
+    """The machine of a reservation's timer, if it is still in use by that reservation."""
+    machine = await adm.get_machine_by_id(data['room_id'], data['machine_id'])
+    if machine and machine['status'] == 'in_use' and machine['code'] == data['code']:
+        return machine
+    return None
+
+@metrics.track_handler
+async def machine_finished(bot, data: dict):
+    """Timer callback: tell the user their laundry is ready, and interested users that the machine is finishing."""
+    machine_id = data['machine_id']
+    # Also False if the user was already told, before a restart
+    if not await adm.mark_finished(data['room_id'], machine_id, data['code']):
+        return
+    
+    await broadcaster.send(
+        bot,
+        data['user_id'],
+        f"⏰ *Your laundry is ready!*\n\n"
+        f"Machine {machine_id} has finished.\n"
+        f"Please collect your laundry using your code: `{data['code']}`",
+        parse_mode='Markdown'
+    )
+    
+    # Combined into one message per user by the broadcaster
+    notify_users(bot, data['room_id'], machine_id, f"🔔 Machine {machine_id} has finished and will be free soon!")
+    
+    if REMINDER_MINUTES:
+        timers.schedule((data['room_id'], machine_id), 'reminder', time.time() + REMINDER_MINUTES[0] * 60,
+                        send_reminder, dict(data, reminder=0))
+
+@metrics.track_handler
+async def send_reminder(bot, data: dict):
+    """Timer callback: remind the user that their laundry is still waiting, more urgently each time."""
+    machine_id = data['machine_id']
+    if not await still_reserved(data):
+        return
+    
+    index = data['reminder']
+    minutes = int(max(0, time.time() - data['end_time']) // 60)
+    if index == 0:
+        text = f"🧺 Reminder: your laundry in {machine_id} finished {minutes} minutes ago."
+    else:
+        text = f"⚠️ Your laundry in {machine_id} has been waiting for {minutes} minutes. Others need the machine!"
+    if AUTO_RELEASE_MINUTES > 0:
+        release_at = datetime.fromtimestamp(data['end_time'] + AUTO_RELEASE_MINUTES * 60)
+        text += f"\nIf it isn't collected by {release_at.strftime('%H:%M')}, the machine will be released."
+    await broadcaster.send(bot, data['user_id'], text + f"\n\nYour code: `{data['code']}`", parse_mode='Markdown')
+    
+    if index + 1 < len(REMINDER_MINUTES):
+        timers.schedule((data['room_id'], machine_id), 'reminder', time.time() + REMINDER_MINUTES[index + 1] * 60,
+                        send_reminder, dict(data, reminder=index + 1))
+
+@metrics.track_handler
+async def release_abandoned(bot, data: dict):
+    """Timer callback: free a machine whose laundry was never collected, and pass it on."""
+    machine_id = data['machine_id']
+    if not await adm.release_machine(data['room_id'], machine_id, data['code']):
+        # Collected in the meantime
+        return
+    
+    await broadcaster.send(
+        bot,
+        data['user_id'],
+        f"⌛ Your laundry in {machine_id} wasn't collected within {AUTO_RELEASE_MINUTES} minutes, "
+        f"so the machine has been released for others."
+    )
+    await offer_or_announce(bot, data['room_id'], machine_id)
+
+async def offer_or_announce(bot, room_id: str, machine_id: str):
+    """
+    Hold a freed machine for the next user on its waitlist and tell only them, or if
+    nobody is waiting, notify the users interested in the machine that it is free.
+    """
+    user_id = await adm.offer_machine(room_id, machine_id)
+    if user_id is None:
+        notify_users(bot, room_id, machine_id, f"🎉 Machine {machine_id} is now FREE!")
+        return
+    
     keyboard = [
-        [InlineKeyboardButton("📊 Status", callback_data="status")],
-        [InlineKeyboardButton("🔧 Use a Machine", callback_data="use_machine")],
-        [InlineKeyboardButton("✅ Collect Laundry", callback_data="collect")]
+        [InlineKeyboardButton(f"✅ Use {machine_id}", callback_data=f"machine_{machine_id}")],
+        [InlineKeyboardButton("⏭ Pass", callback_data=f"pass_{machine_id}")]
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await query.message.reply_text(
-        "🧺 *Laundry Room Manager*\n\nWhat would you like to do?",
-        reply_markup=reply_markup,
+    sent = await broadcaster.send(
+        bot,
+        user_id,
+        f"🎉 *Your turn!*\n\n"
+        f"Machine {machine_id} is free and held for you for {max(1, dm.CLAIM_TIMEOUT // 60)} minutes.",
+        reply_markup=InlineKeyboardMarkup(keyboard),
         parse_mode='Markdown'
     )
+    
+    # If the user can't be reached, move on to the next one straight away
+    delay = dm.CLAIM_TIMEOUT if sent else 0
+    timers.schedule(
+        (room_id, machine_id),
+        'offer',
+        time.time() + delay,
+        expire_offer,
+        {'room_id': room_id, 'machine_id': machine_id, 'user_id': user_id}
+    )
+
+@metrics.track_handler
+async def expire_offer(bot, data: dict):
+    """Timer callback: pass a held machine on if its user didn't claim it in time."""
+    room_id = data['room_id']
+    machine_id = data['machine_id']
+    user_id = data['user_id']
+    
+    if not await adm.release_offer(room_id, machine_id, user_id):
+        # Already claimed or passed on
+        return
+    
+    await broadcaster.send(bot, user_id, f"⌛ {machine_id} was not claimed in time and has been passed on.")
+    await offer_or_announce(bot, room_id, machine_id)
 
-async def send_machine_notification(context: ContextTypes.DEFAULT_TYPE):
-    """Job queue callback to send notification when machine finishes."""
-    job_data = context.job.data
-    machine_id = job_data['machine_id']
-    user_id = job_data['user_id']
+async def run_timers(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Job queue callback: advance the timing wheel and start the timers that are due.
+    Their callbacks run as background tasks, so one waiting on a rate limit doesn't
+    hold up the next tick.
+    """
+    now = time.time()
+    due = timers.advance(now)
     
-    # Check if machine is still in use (user might have collected early)
-    machine = dm.get_machine_by_id(machine_id)
-    if machine and machine['status'] == 'in_use' and machine['user_id'] == str(user_id):
-        # Notify the user who started it
+    async def run(timer):
+        metrics.observe('laundry_job_lag_seconds', max(0.0, now - timer.when), job=timer.kind)
         try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"⏰ *Your laundry is ready!*\n\n"
-                     f"Machine {machine_id} has finished.\n"
-                     f"Please collect your laundry using your code: `{machine['code']}`",
-                parse_mode='Markdown'
-            )
+            await timer.callback(context.bot, timer.data)
         except Exception as e:
-            print(f"Could not send message to user {user_id}: {e}")
-        
-        # Notify all other users
-        await notify_all_users(
-            context.bot,
-            f"🔔 Machine {machine_id} has finished and will be free soon!"
+            print(f"Timer {timer.kind} for {timer.group} failed: {e}")
+    
+    loop = asyncio.get_running_loop()
+    for timer in due:
+        task = loop.create_task(run(timer))
+        _timer_tasks.add(task)
+        task.add_done_callback(_timer_tasks.discard)
+
+async def post_init(application: Application):
+    """Set up background work once the bot is connected."""
+    restore_timers()
+    application.job_queue.run_repeating(run_timers, interval=timers.TICK_SECONDS, name="timers")
+    broadcaster.on_unreachable(unsubscribe_unreachable)
+    application.job_queue.run_repeating(
+        compact_users,
+        interval=USERS_COMPACT_INTERVAL,
+        first=USERS_COMPACT_INTERVAL,
+        name="compact_users"
+    )
+    
+    if LIVE_STATUS_CHAT:
+        chat = await application.bot.get_chat(LIVE_STATUS_CHAT)
+        if chat.id not in dm.get_live_boards():
+            await live_status.post_board(application.bot, chat.id, dm.get_default_room())
+    
+    application.job_queue.run_repeating(
+        live_status.refresh_boards,
+        interval=live_status.REFRESH_INTERVAL,
+        name="refresh_live_status"
+    )
+
+def restore_timers():
+    """
+    Set the timers of machines in use again after a restart. Machines that finished
+    while the bot was down are notified on the first tick; for those whose user was
+    already notified, only the remaining reminders and the release are set.
+    """
+    for machine in dm.check_running_machines() + dm.check_finished_machines():
+        finished_at = machine['finished_at']
+        schedule_machine_timers(
+            machine['room_id'],
+            machine['machine_id'],
+            int(machine['user_id']),
+            machine['code'],
+            datetime.fromisoformat(machine['end_time']).timestamp(),
+            datetime.fromisoformat(finished_at).timestamp() if finished_at else None
         )
 
-async def notify_all_users(bot, message: str):
-    """Send a notification to all subscribed users."""
-    users = dm.get_all_users()
+async def unsubscribe_unreachable(user_id: int):
+    """Stop notifying a user who blocked the bot or deleted their account."""
+    user = await adm.get_user(user_id)
+    if user and user['subscribed'] == 'yes':
+        await adm.set_subscribed(user_id, False)
+        metrics.inc('laundry_users_unsubscribed_total')
+        print(f"🔕 Unsubscribed user {user_id}, who can no longer be messaged")
+
+async def compact_users(context: ContextTypes.DEFAULT_TYPE):
+    """Rewrite the users file with one row per user."""
+    await adm.compact_users()
+
+async def drain_broadcasts(application: Application):
+    """Let running timer callbacks and background broadcasts finish before shutting down."""
+    if _timer_tasks:
+        await asyncio.wait(list(_timer_tasks), timeout=30)
+    await broadcaster.drain()
+
+def notify_users(bot, room_id: str, machine_id: str, message: str):
+    """
+    Send a notification about a machine in the background, to the subscribed users of
+    its room interested in it. Notifications close together are combined, and a later
+    one about the same machine replaces an earlier one.
+    """
+    user_ids = dm.get_interested_users(room_id, machine_id)
+    broadcaster.queue_broadcast(bot, user_ids, message, key=(room_id, machine_id))
+
+TOPIC_NAMES = {'washers': 'washing_machine', 'dryers': 'dryer'}
+
+def describe_notifications(user: dict) -> str:
+    if user['subscribed'] != 'yes':
+        return "🔕 Notifications are off. Turn them on with /subscribe"
     
-    for user in users:
+    names = {topic: name for name, topic in TOPIC_NAMES.items()}
+    topics = user['topics'].split()
+    if 'all' in topics:
+        text = "🔔 You are notified about all machines."
+    else:
+        text = "🔔 You are notified about: " + ", ".join(names.get(t, t) for t in topics) + "."
+    if user['quiet_hours']:
+        text += f"\n🌙 Quiet hours: {user['quiet_hours']}"
+    return text + (
+        "\n\nChange with /notify all, /notify washers, /notify dryers, /notify WM1 D2 ... "
+        "or /stop, and set quiet hours with /quiet 23-7 (/quiet off to clear)."
+    )
+
+@metrics.track_handler
+async def notify(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show or change what the user gets notified about."""
+    user_id = update.effective_user.id
+    await adm.add_user(user_id, update.effective_user.username)
+    
+    args = [arg.lower() for arg in context.args]
+    if args == ['on'] or args == ['off']:
+        await adm.set_subscribed(user_id, args[0] == 'on')
+    elif args:
+        room_id = await adm.get_user_room(user_id)
+        machine_ids = {m['machine_id'].lower(): m['machine_id'] for m in await adm.get_all_machines(room_id)}
+        topics = []
+        for arg in args:
+            if arg == 'all':
+                topics = ['all']
+                break
+            topic = TOPIC_NAMES.get(arg) or machine_ids.get(arg)
+            if not topic:
+                await update.message.reply_text(f"❌ Unknown machine or type: {arg}")
+                return
+            topics.append(topic)
+        await adm.set_topics(user_id, topics)
+        await adm.set_subscribed(user_id, True)
+    
+    await update.message.reply_text(describe_notifications(await adm.get_user(user_id)))
+
+@metrics.track_handler
+async def stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Turn all notifications off (/subscribe turns them back on)."""
+    user_id = update.effective_user.id
+    await adm.add_user(user_id, update.effective_user.username)
+    await adm.set_subscribed(user_id, False)
+    
+    await update.message.reply_text(
+        "🔕 You won't get any more notifications about machines.\n\n"
+        "Send /subscribe to turn them back on."
+    )
+
+@metrics.track_handler
+async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Turn notifications back on, with the machines chosen before."""
+    user_id = update.effective_user.id
+    await adm.add_user(user_id, update.effective_user.username)
+    await adm.set_subscribed(user_id, True)
+    
+    await update.message.reply_text(describe_notifications(await adm.get_user(user_id)))
+
+@metrics.track_handler
+async def quiet(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Set hours in which the user gets no notifications (/quiet 23-7, /quiet off)."""
+    user_id = update.effective_user.id
+    await adm.add_user(user_id, update.effective_user.username)
+    
+    if context.args and context.args[0].lower() == 'off':
+        await adm.set_quiet_hours(user_id, None, None)
+    else:
         try:
-            await bot.send_message(
-                chat_id=int(user['user_id']),
-                text=message
-            )
-        except Exception as e:
-            print(f"Could not send message to user {user['user_id']}: {e}")
+            start_hour, end_hour = (int(hour) for hour in context.args[0].split('-'))
+            if not (0 <= start_hour < 24 and 0 <= end_hour < 24):
+                raise ValueError
+        except (IndexError, ValueError):
+            await update.message.reply_text("Usage: /quiet 23-7 (hours 0-23), or /quiet off")
+            return
+        await adm.set_quiet_hours(user_id, start_hour, end_hour)
+    
+    await update.message.reply_text(describe_notifications(await adm.get_user(user_id)))
+
+@metrics.track_handler
+async def live(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Post a status message for the user's room in this chat that keeps itself up to date (/live off to stop)."""
+    chat_id = update.effective_chat.id
+    
+    if context.args and context.args[0].lower() == 'off':
+        live_status.forget_board(chat_id)
+        if await adm.remove_live_board(chat_id):
+            await update.message.reply_text("🛑 Live status stopped.")
+        else:
+            await update.message.reply_text("There is no live status in this chat.")
+        return
+    
+    await live_status.post_board(context.bot, chat_id, await adm.get_user_room(update.effective_user.id))
+
+@metrics.track_handler
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show bot statistics to admins."""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    if not metrics.enabled:
+        await update.message.reply_text("📈 Metrics are disabled. Set METRICS_PORT in .env to enable them.")
+        return
+    
+    # Telegram messages are limited to 4096 characters
+    await update.message.reply_text(metrics.format_stats()[:4000])
+
+HISTORY_ACTIONS = {'use': "started", 'finish': "finished (user notified)", 'collect': "collected",
+                   'expire': "released (not collected)"}
+
+@metrics.track_handler
+async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show admins the latest machine uses and collections in their room (/history [machine])."""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    room_id = await adm.get_user_room(update.effective_user.id)
+    machine_id = context.args[0].upper() if context.args else None
+    events = await adm.get_machine_history(room_id, machine_id)
+    if not events:
+        await update.message.reply_text("No machine history yet.")
+        return
+    
+    lines = [f"📜 Machine history{f' for {machine_id}' if machine_id else ''}", room_line(room_id)]
+    for event in events:
+        action = HISTORY_ACTIONS.get(event['event'], event['event'])
+        lines.append(f"{event['time'].replace('T', ' ')}  {event['machine_id']} {action} by {event['username'] or event['user_id']}")
+    # Collection codes are left out, since the latest one may still be in use
+    await update.message.reply_text("\n".join(lines)[:4000])
+
+def build_usage_report(events: list, export: bool) -> tuple:
+    """Compute the usage report (and CSV exports) from machine events."""
+    sessions = analytics.build_sessions(events)
+    report = analytics.format_report(sessions)
+    if not export:
+        return report, None, None
+    heatmap = analytics.occupancy_heatmap(sessions)
+    return report, analytics.export_sessions_csv(sessions), analytics.export_heatmap_csv(heatmap)
+
+@metrics.track_handler
+async def usage(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show admins a usage report for their room (/usage), or export it as CSV files (/usage csv)."""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    export = bool(context.args) and context.args[0].lower() == 'csv'
+    room_id = await adm.get_user_room(update.effective_user.id)
+    events = await adm.get_machine_history(room_id, limit=None)
+    # A year of history takes a fraction of a second, but keep it off the event loop
+    report, sessions_csv, heatmap_csv = await asyncio.get_running_loop().run_in_executor(
+        None, build_usage_report, events, export
+    )
+    
+    await update.message.reply_text(report[:4000])
+    if export:
+        await update.message.reply_document(io.BytesIO(sessions_csv.encode()), filename="laundry_usage.csv")
+        await update.message.reply_document(io.BytesIO(heatmap_csv.encode()), filename="laundry_occupancy.csv")
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that counts Bot API calls and failures by method."""
+    
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        metrics.inc('laundry_telegram_requests_total', method=api_method)
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            metrics.inc('laundry_telegram_failures_total', method=api_method)
+            raise
+        if code != 200:
+            metrics.inc('laundry_telegram_failures_total', method=api_method)
+        return code, payload
 
 def main():
     """Start the bot."""
-    # Initialize CSV files
-    dm.init_csv_files()
+    # Initialize storage
+    dm.init_storage(STORAGE_BACKEND)
     
     if not BOT_TOKEN:
         print("❌ Error: BOT_TOKEN not found in .env file")
@@ -419,10 +1095,34 @@ def main():
         return
     
     # Create application
-    application = Application.builder().token(BOT_TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(post_init)
+        .post_stop(drain_broadcasts)
+        # Keeps users' place in multi-step flows across restarts
+        .persistence(UserStatePersistence())
+    )
+    
+    if METRICS_PORT:
+        metrics.enable()
+        metrics.start_http_server(int(METRICS_PORT))
+        builder = builder.request(InstrumentedRequest(connection_pool_size=256))
+        print(f"📈 Metrics available at http://127.0.0.1:{METRICS_PORT}/metrics")
+    
+    application = builder.build()
     
     # Add handlers
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("notify", notify))
+    application.add_handler(CommandHandler("stop", stop))
+    application.add_handler(CommandHandler("subscribe", subscribe))
+    application.add_handler(CommandHandler("quiet", quiet))
+    application.add_handler(CommandHandler("room", room))
+    application.add_handler(CommandHandler("live", live))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("history", history))
+    application.add_handler(CommandHandler("usage", usage))
     application.add_handler(CallbackQueryHandler(button_handler))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_code_message))
     
@@ -430,7 +1130,22 @@ def main():
     print("🤖 Bot is starting...")
     print("✅ Bot is running! Press Ctrl+C to stop.")
     
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        print(f"🌐 Listening for webhook updates on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES
+        )
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
+    
+    # Write any pending machine state before exiting
+    adm.shutdown()
+    dm.close_storage()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,234 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from telegram.error import BadRequest, Forbidden
+
+# Telegram allows roughly 30 messages per second overall and 1 per second per chat
+GLOBAL_RATE = 30
+PER_CHAT_RATE = 1
+MAX_CONCURRENCY = 20
+MAX_RETRIES = 3
+
+# Broadcast events queued within this many seconds of each other are combined into
+# one message per user (0 sends every event straight away)
+COALESCE_WINDOW = 30.0
+
+class TokenBucket:
+    """Token bucket rate limiter for use on a single event loop."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        """Take a token and return how many seconds to wait before using it."""
+        self._refill()
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def pause(self, seconds: float):
+        """Hold back all tokens for the given number of seconds."""
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    def try_take(self) -> bool:
+        """Take a token if one is available now, without waiting. Returns False if there is none."""
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def wait_time(self) -> float:
+        """Seconds until a token is available."""
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+_global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+_chat_buckets: Dict[int, TokenBucket] = {}
+
+# Bad Request descriptions meaning a chat can never be messaged again (Forbidden errors,
+# e.g. "bot was blocked by the user" or "user is deactivated", always mean that)
+PERMANENT_ERRORS = ("chat not found", "user not found", "peer_id_invalid", "user is deactivated")
+
+# Awaited with the chat_id when a message to it fails permanently
+_unreachable_handler: Optional[Callable[[int], Awaitable]] = None
+
+# Keep references to running broadcasts so they aren't garbage collected
+_tasks: Set[asyncio.Task] = set()
+
+# Events waiting to be combined: key -> (text, recipients). A later event with the
+# same key replaces an earlier one (e.g. "finished" followed by "now free").
+_pending: Dict[object, Tuple[str, Set[int]]] = {}
+_pending_bot = None
+_flush_handle: Optional[asyncio.TimerHandle] = None
+
+def _retry_after_seconds(error: Exception) -> float:
+    """Get the flood-wait from a RetryAfter error (int or timedelta), or 0."""
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after is None:
+        return 0
+    if hasattr(retry_after, 'total_seconds'):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+def is_permanent_failure(error: Exception) -> bool:
+    """
+    True if the error means messages to the chat will never get through (the bot was
+    blocked, the account deleted, the chat doesn't exist); False for transient errors.
+    """
+    if isinstance(error, Forbidden):
+        return True
+    return isinstance(error, BadRequest) and any(text in str(error).lower() for text in PERMANENT_ERRORS)
+
+def on_unreachable(handler: Optional[Callable[[int], Awaitable]]):
+    """Set a coroutine function to call with the chat_id whenever send() fails permanently."""
+    global _unreachable_handler
+    _unreachable_handler = handler
+
+async def call_limited(chat_id: int, request):
+    """
+    Run request() (a Bot API call for chat_id) within the rate limits, retrying on
+    flood-wait. Other errors are raised to the caller.
+    """
+    bucket = _chat_buckets.get(chat_id)
+    if bucket is None:
+        bucket = _chat_buckets[chat_id] = TokenBucket(PER_CHAT_RATE, 1)
+
+    for attempt in range(MAX_RETRIES + 1):
+        await bucket.acquire()
+        await _global_bucket.acquire()
+        try:
+            return await request()
+        except Exception as e:
+            retry_after = _retry_after_seconds(e)
+            if not retry_after or attempt == MAX_RETRIES:
+                raise
+            # Flood control applies to the whole bot, so hold back every call
+            _global_bucket.pause(retry_after)
+
+async def send(bot, chat_id: int, text: str, **kwargs) -> bool:
+    """
+    Send one message within the rate limits, retrying on flood-wait. Returns True if sent.
+    Chats that can't be messaged anymore are reported to the on_unreachable() handler.
+    """
+    try:
+        await call_limited(chat_id, lambda: bot.send_message(chat_id=chat_id, text=text, **kwargs))
+        return True
+    except Exception as e:
+        print(f"Could not send message to user {chat_id}: {e}")
+        if _unreachable_handler is not None and is_permanent_failure(e):
+            try:
+                await _unreachable_handler(chat_id)
+            except Exception as handler_error:
+                print(f"Could not handle unreachable user {chat_id}: {handler_error}")
+        return False
+
+async def edit(bot, chat_id: int, message_id: int, text: str, **kwargs) -> bool:
+    """
+    Edit a message's text within the rate limits. Returns True if the message now shows text;
+    errors other than "message is not modified" are raised to the caller.
+    """
+    try:
+        await call_limited(
+            chat_id,
+            lambda: bot.edit_message_text(text=text, chat_id=chat_id, message_id=message_id, **kwargs)
+        )
+    except Exception as e:
+        if "not modified" not in str(e).lower():
+            raise
+    return True
+
+async def broadcast(bot, chat_ids: Iterable[int], text: str, **kwargs) -> int:
+    """Send a message to many chats concurrently. Returns the number sent."""
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+
+    async def send_limited(chat_id):
+        async with semaphore:
+            return await send(bot, chat_id, text, **kwargs)
+
+    results = await asyncio.gather(*(send_limited(chat_id) for chat_id in chat_ids))
+
+    # Forget chats whose buckets have refilled
+    for chat_id in [c for c, b in _chat_buckets.items() if b.is_full()]:
+        del _chat_buckets[chat_id]
+
+    return sum(results)
+
+def schedule_broadcast(bot, chat_ids: Iterable[int], text: str, **kwargs) -> asyncio.Task:
+    """Start a broadcast in the background and return its task."""
+    task = asyncio.get_running_loop().create_task(broadcast(bot, list(chat_ids), text, **kwargs))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+def queue_broadcast(bot, chat_ids: Iterable[int], text: str, key: object = None):
+    """
+    Queue a broadcast to be combined with others sent within COALESCE_WINDOW, so each
+    user gets one message per window. Events with the same key replace each other.
+    """
+    global _pending_bot, _flush_handle
+    if COALESCE_WINDOW <= 0:
+        schedule_broadcast(bot, chat_ids, text)
+        return
+
+    if key is None:
+        key = object()
+    # Move a replaced event to the end, so lines stay in the order things happened
+    _pending.pop(key, None)
+    _pending[key] = (text, set(chat_ids))
+    _pending_bot = bot
+    if _flush_handle is None:
+        _flush_handle = asyncio.get_running_loop().call_later(COALESCE_WINDOW, flush_pending)
+
+def combine_messages(lines: List[str]) -> str:
+    if len(lines) == 1:
+        return lines[0]
+    return "🧺 Laundry updates:\n\n" + "\n".join(lines)
+
+def flush_pending():
+    """Send the queued broadcast events now, one combined message per user."""
+    global _flush_handle
+    if _flush_handle is not None:
+        _flush_handle.cancel()
+        _flush_handle = None
+    if not _pending:
+        return
+
+    events = list(_pending.values())
+    _pending.clear()
+
+    # Users who get exactly the same events share one broadcast
+    lines_by_user: Dict[int, list] = {}
+    for text, recipients in events:
+        for chat_id in recipients:
+            lines_by_user.setdefault(chat_id, []).append(text)
+    users_by_lines: Dict[tuple, List[int]] = {}
+    for chat_id, lines in lines_by_user.items():
+        users_by_lines.setdefault(tuple(lines), []).append(chat_id)
+
+    for lines, chat_ids in users_by_lines.items():
+        schedule_broadcast(_pending_bot, chat_ids, combine_messages(list(lines)))
+
+async def drain(timeout: float = 30):
+    """Send any queued events and wait for background broadcasts to finish, up to timeout seconds."""
+    flush_pending()
+    if _tasks:
+        await asyncio.wait(list(_tasks), timeout=timeout)
@@ -1,236 +1,902 @@
 import csv
+import heapq
+import itertools
+import json
 import os
 import random
+import re
 import string
+import threading
+import time
+from collections import deque
 from datetime import datetime, timedelta
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Set
+
+from telegram.helpers import escape_markdown
+
+import metrics
+import timers
+from storage import (CSVMachineStorage, CSVStorage, MachineStorage, SQLiteMachineStorage,
+                     SQLiteStorage, Storage, next_version)
 
 # File paths
 MACHINES_FILE = "machines.csv"
 USERS_FILE = "users.csv"
+BOARDS_FILE = "live_boards.csv"
+USER_STATE_FILE = "user_state.csv"
+MACHINE_JOURNAL_FILE = "machine_events.csv"
+MACHINE_HISTORY_FILE = "machine_history.csv"
+DATABASE_FILE = "laundry.db"
+
+# Laundry rooms: one row per room with room_id, name, washing_machines and dryers.
+# The first room keeps its machines in the files above; every other room gets its own
+# directory under ROOMS_DIR. Without a rooms file there is one room with the machine
+# counts below.
+ROOMS_FILE = "rooms.csv"
+ROOMS_DIR = "rooms"
+DEFAULT_ROOM = "main"
+DEFAULT_ROOM_NAME = "Laundry Room"
 
 # Machine types
 WASHING_MACHINES = 4
 DRYERS = 3
 
-def init_csv_files():
-    """Initialize CSV files if they don't exist."""
+# Seconds to wait before persisting machine state, so a burst of updates shares one write
+FLUSH_DELAY = 1.0
+
+# Seconds a freed machine is held for the next user on the waitlist
+CLAIM_TIMEOUT = 120
+
+class Room:
+    """
+    The machines of one laundry room and everything derived from them. Rooms share no
+    locks or files, so a change in one room never waits on or rewrites another.
+    """
+
+    def __init__(self, room_id: str, name: str, storage: MachineStorage):
+        self.room_id = room_id
+        self.name = name
+        self.storage = storage
+        
+        # Machine state (machine_id -> row). Rows are replaced rather than modified, so
+        # readers never need a lock. Writers hold the machine's own lock, so different
+        # machines can be updated in parallel.
+        self.machines: Dict[str, Dict] = {}
+        self.machine_locks: Dict[str, threading.Lock] = {}
+        # Parsed end time for every machine in use
+        self.end_times: Dict[str, datetime] = {}
+        
+        # Per machine type, a min-heap of (end_time, machine_id) for machines in use, and
+        # how many are in use. Entries left behind by collected machines no longer match
+        # end_times; they are dropped when they reach the top, and the heap is rebuilt
+        # without them once they outnumber the live ones.
+        self.end_time_heaps: Dict[str, List[tuple]] = {}
+        self.in_use_counts: Dict[str, int] = {}
+        self.machine_counts: Dict[str, int] = {}
+        self.heap_lock = threading.Lock()
+        
+        # Machine events (uses and collections) not yet persisted, in order
+        self.pending_events: List[Dict] = []
+        self.flush_lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.flush_timer: Optional[threading.Timer] = None
+        
+        # Bumped on every change, so rendered views can be cached
+        self.state_version = 0
+        self.version_lock = threading.Lock()
+        self.status_cache: Optional[tuple] = None
+        
+        # Waitlists: machine_type -> user_ids in the order they joined. A freed machine is
+        # offered to the head of the queue and held for them: machine_id -> (user_id, expiry).
+        # Waitlists only live in memory, so they are empty after a restart.
+        self.waitlists: Dict[str, deque] = {}
+        self.offers: Dict[str, tuple] = {}
+        self.waitlist_lock = threading.Lock()
+
+_storage: Optional[Storage] = None
+
+# room_id -> Room, in the order of the rooms file; loaded once by init_storage()
+_rooms: Dict[str, Room] = {}
+_default_room = DEFAULT_ROOM
+
+# Version numbers are unique across rooms
+_version_counter = itertools.count(1)
+
+# Collection code -> (room_id, machine_id) for every machine in use, in every room
+_codes: Dict[str, tuple] = {}
+
+# In-memory user registry (user_id -> row), loaded once by init_storage()
+_users: Dict[str, Dict] = {}
+_users_lock = threading.RLock()
+_user_write_lock = threading.Lock()
+
+# Inverted index of subscribed users: "room_id:topic" -> user_ids. A topic is 'all', a
+# machine type ('washing_machine' or 'dryer') or a machine ID in the user's room.
+_topic_index: Dict[str, Set[str]] = {}
+# user_id -> (start_hour, end_hour) for subscribed users with quiet hours
+_quiet_hours: Dict[str, tuple] = {}
+
+# Live status boards: chat_id -> (message_id, room_id) of the status message kept up to date there
+_boards: Dict[int, tuple] = {}
+_boards_lock = threading.Lock()
+
+def load_room_config() -> List[Dict]:
+    """Read the laundry rooms from ROOMS_FILE, or a single room if there is none."""
+    if not os.path.exists(ROOMS_FILE):
+        return [{'room_id': DEFAULT_ROOM, 'name': DEFAULT_ROOM_NAME,
+                 'washing_machines': WASHING_MACHINES, 'dryers': DRYERS}]
     
-    # Initialize machines.csv
-    if not os.path.exists(MACHINES_FILE):
-        with open(MACHINES_FILE, 'w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(['machine_id', 'machine_type', 'status', 'user_id', 'username', 'code', 'end_time'])
-            
-            # Create washing machines
-            for i in range(1, WASHING_MACHINES + 1):
-                writer.writerow([f'WM{i}', 'washing_machine', 'free', '', '', '', ''])
-            
-            # Create dryers
-            for i in range(1, DRYERS + 1):
-                writer.writerow([f'D{i}', 'dryer', 'free', '', '', '', ''])
+    rooms = []
+    with open(ROOMS_FILE, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            room_id = (row.get('room_id') or '').strip()
+            # Room IDs are used in file paths and button data
+            if not re.fullmatch(r'[A-Za-z0-9-]{1,32}', room_id):
+                raise ValueError(f"Invalid room ID in {ROOMS_FILE}: {room_id!r}")
+            if any(room['room_id'] == room_id for room in rooms):
+                raise ValueError(f"Duplicate room ID in {ROOMS_FILE}: {room_id}")
+            rooms.append({
+                'room_id': room_id,
+                'name': (row.get('name') or '').strip() or room_id,
+                'washing_machines': int(row.get('washing_machines') or 0),
+                'dryers': int(row.get('dryers') or 0),
+            })
+    if not rooms:
+        raise ValueError(f"No rooms in {ROOMS_FILE}")
+    return rooms
+
+def _room_machine_storage(backend: str, room_id: str, default: bool) -> MachineStorage:
+    if default:
+        directory = ""
+    else:
+        directory = os.path.join(ROOMS_DIR, room_id)
+        os.makedirs(directory, exist_ok=True)
+    
+    csv_storage = CSVMachineStorage(
+        os.path.join(directory, MACHINES_FILE),
+        os.path.join(directory, MACHINE_JOURNAL_FILE),
+        os.path.join(directory, MACHINE_HISTORY_FILE)
+    )
+    if backend == "sqlite":
+        # Existing CSV files are imported the first time the database is created
+        return SQLiteMachineStorage(os.path.join(directory, DATABASE_FILE), import_from=csv_storage)
+    return csv_storage
+
+def init_storage(backend: str = "csv"):
+    """Open the storage backend ('csv' or 'sqlite') and load rooms, machines and users."""
+    global _storage, _default_room
+    
+    if backend not in ("csv", "sqlite"):
+        raise ValueError(f"Unknown storage backend: {backend}")
+    csv_storage = CSVStorage(USERS_FILE, BOARDS_FILE, USER_STATE_FILE)
+    if backend == "sqlite":
+        # Existing CSV files are imported the first time the database is created
+        _storage = SQLiteStorage(DATABASE_FILE, import_from=csv_storage)
+    else:
+        _storage = csv_storage
+    _storage.init()
+    
+    config = load_room_config()
+    _default_room = config[0]['room_id']
+    _rooms.clear()
+    _codes.clear()
+    for index, room_config in enumerate(config):
+        room_id = room_config['room_id']
+        room = Room(room_id, room_config['name'], _room_machine_storage(backend, room_id, index == 0))
+        
+        machines = []
+        # Create washing machines
+        for i in range(1, room_config['washing_machines'] + 1):
+            machines.append(_free_machine(f'WM{i}', 'washing_machine'))
+        # Create dryers
+        for i in range(1, room_config['dryers'] + 1):
+            machines.append(_free_machine(f'D{i}', 'dryer'))
+        
+        room.storage.init(machines)
+        _rooms[room_id] = room
+        load_machines(room_id)
     
-    # Initialize users.csv
-    if not os.path.exists(USERS_FILE):
-        with open(USERS_FILE, 'w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(['user_id', 'username', 'subscribed'])
+    load_users()
+    load_live_boards()
+
+def _free_machine(machine_id: str, machine_type: str) -> Dict:
+    return {'machine_id': machine_id, 'machine_type': machine_type, 'status': 'free',
+            'user_id': '', 'username': '', 'code': '', 'end_time': '', 'finished_at': '', 'version': '0'}
+
+def get_rooms() -> Dict[str, str]:
+    """Get all laundry rooms as room_id -> name, the default room first."""
+    return {room_id: room.name for room_id, room in _rooms.items()}
+
+def get_room_name(room_id: str) -> str:
+    room = _rooms.get(room_id)
+    return room.name if room else room_id
+
+def get_default_room() -> str:
+    return _default_room
+
+def load_machines(room_id: str):
+    """Load a room's machines from storage into memory."""
+    room = _rooms[room_id]
+    machines = {row['machine_id']: row for row in room.storage.load_machines()}
+    metrics.inc('laundry_storage_reads_total', op='load_machines')
+    for code in [code for code, (code_room, _) in _codes.items() if code_room == room_id]:
+        del _codes[code]
+    end_times = {}
+    for machine in machines.values():
+        if machine['status'] != 'in_use':
+            continue
+        if machine['code']:
+            _codes[machine['code']] = (room_id, machine['machine_id'])
+        if machine['end_time']:
+            try:
+                end_times[machine['machine_id']] = datetime.fromisoformat(machine['end_time'])
+            except ValueError:
+                pass
+    room.machines = machines
+    room.end_times = end_times
+    with room.heap_lock:
+        room.end_time_heaps.clear()
+        room.in_use_counts.clear()
+        room.machine_counts.clear()
+        for machine in machines.values():
+            machine_type = machine['machine_type']
+            room.machine_counts[machine_type] = room.machine_counts.get(machine_type, 0) + 1
+            room.end_time_heaps.setdefault(machine_type, [])
+            if machine['status'] == 'in_use':
+                room.in_use_counts[machine_type] = room.in_use_counts.get(machine_type, 0) + 1
+                if machine['machine_id'] in end_times:
+                    room.end_time_heaps[machine_type].append((end_times[machine['machine_id']], machine['machine_id']))
+        for heap in room.end_time_heaps.values():
+            heapq.heapify(heap)
+    room.machine_locks.clear()
+    for machine_id in machines:
+        room.machine_locks[machine_id] = threading.Lock()
+    _bump_version(room)
+
+def _bump_version(room: Room):
+    """Record a change in a room."""
+    with room.version_lock:
+        room.state_version = next(_version_counter)
+
+def get_state_version(room_id: str) -> int:
+    """Get a number that changes whenever anything in a room changes."""
+    room = _rooms.get(room_id)
+    return room.state_version if room else 0
+
+def get_machine_version(room_id: str, machine_id: str) -> Optional[int]:
+    """Get a number that changes whenever the given machine is used or freed, kept across restarts."""
+    room = _rooms.get(room_id)
+    machine = room.machines.get(machine_id) if room else None
+    return int(machine['version']) if machine else None
+
+def _record_event(room: Room, event: str, machine: Dict):
+    """
+    Queue a machine event to be persisted, coalescing with any pending write to the
+    room. Call with the machine's lock held, so each machine's events are queued in order.
+    """
+    with room.flush_lock:
+        room.pending_events.append({
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'event': event,
+            'machine_id': machine['machine_id'],
+            'user_id': machine['user_id'],
+            'username': machine['username'],
+            'code': machine['code'],
+            'end_time': machine['end_time'],
+        })
+        if room.flush_timer is None:
+            room.flush_timer = threading.Timer(FLUSH_DELAY, flush_machines, args=(room.room_id,))
+            room.flush_timer.daemon = True
+            room.flush_timer.start()
+
+def flush_machines(room_id: Optional[str] = None):
+    """Persist any pending machine changes in a room, or in every room."""
+    if room_id is None:
+        for room_id in list(_rooms):
+            flush_machines(room_id)
+        return
+    
+    room = _rooms[room_id]
+    with room.write_lock:
+        with room.flush_lock:
+            if room.flush_timer is not None:
+                room.flush_timer.cancel()
+                room.flush_timer = None
+            if not room.pending_events:
+                return
+            events = list(room.pending_events)
+            room.pending_events.clear()
+        rows = list(room.machines.values())
+        
+        room.storage.save_machines(rows, events)
+        metrics.inc('laundry_storage_writes_total', op='save_machines')
+
+def close_storage():
+    """Persist pending changes and close the storage backend."""
+    flush_machines()
+    for room in _rooms.values():
+        room.storage.close()
+    _storage.close()
 
 def generate_code(length=6):
     """Generate a random alphanumeric code."""
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
 
+def _allocate_code(room_id: str, machine_id: str) -> str:
+    """Generate a code that no other machine in use (in any room) has and assign it to the machine."""
+    key = (room_id, machine_id)
+    while True:
+        code = generate_code()
+        # setdefault is atomic, so two machines can never claim the same code
+        if _codes.setdefault(code, key) == key:
+            return code
+
+def load_users():
+    """Load users from storage into the in-memory user registry."""
+    global _users
+    users = {row['user_id']: row for row in _storage.load_users()}
+    metrics.inc('laundry_storage_reads_total', op='load_users')
+    with _users_lock:
+        _users = {}
+        _topic_index.clear()
+        _quiet_hours.clear()
+        for user in users.values():
+            _update_user(user)
+
+def _parse_quiet_hours(value: str) -> Optional[tuple]:
+    """Parse quiet hours like '23-7' into (23, 7)."""
+    try:
+        start, end = (int(hour) % 24 for hour in value.split('-'))
+        return start, end
+    except ValueError:
+        return None
+
+def _is_quiet(quiet_hours: Optional[tuple], hour: int) -> bool:
+    if not quiet_hours:
+        return False
+    start, end = quiet_hours
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+def _user_room(user: Dict) -> str:
+    """The room a user belongs to: the one they chose, or the default room."""
+    return user['room'] if user['room'] in _rooms else _default_room
+
+def _update_user(user: Dict):
+    """Store a new or changed user in memory and in the topic index. Call with _users_lock held."""
+    user_id = user['user_id']
+    old = _users.get(user_id)
+    if old and old['subscribed'] == 'yes':
+        for topic in old['topics'].split():
+            _topic_index.get(f"{_user_room(old)}:{topic}", set()).discard(user_id)
+        _quiet_hours.pop(user_id, None)
+    
+    user.setdefault('topics', 'all')
+    user.setdefault('quiet_hours', '')
+    user.setdefault('room', '')
+    _users[user_id] = user
+    if user['subscribed'] == 'yes':
+        for topic in user['topics'].split():
+            _topic_index.setdefault(f"{_user_room(user)}:{topic}", set()).add(user_id)
+        quiet_hours = _parse_quiet_hours(user['quiet_hours']) if user['quiet_hours'] else None
+        if quiet_hours:
+            _quiet_hours[user_id] = quiet_hours
+
+def _change_user(user_id: int, **changes) -> bool:
+    """Update fields of a user in memory and storage. Returns False if the user is unknown."""
+    with _user_write_lock:
+        with _users_lock:
+            user = _users.get(str(user_id))
+            if not user:
+                return False
+            if all(user.get(field) == value for field, value in changes.items()):
+                return True
+            user = dict(user, **changes)
+            _update_user(user)
+        _storage.save_user(dict(user))
+        metrics.inc('laundry_storage_writes_total', op='save_user')
+        return True
+
+def compact_users():
+    """Reclaim space used by old user records in storage."""
+    with _user_write_lock:
+        _storage.compact_users()
+        metrics.inc('laundry_storage_writes_total', op='compact_users')
+
 def add_user(user_id: int, username: str):
     """Add a new user to the users file if they don't exist."""
-    users = get_all_users()
-    
-    # Check if user already exists
-    for user in users:
-        if user['user_id'] == str(user_id):
-            return
-    
-    # Add new user
-    with open(USERS_FILE, 'a', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow([user_id, username or 'Unknown', 'yes'])
-
-def get_all_users() -> List[Dict]:
-    """Get all subscribed users."""
-    users = []
-    with open(USERS_FILE, 'r', newline='') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if row['subscribed'] == 'yes':
-                users.append(row)
-    return users
-
-def get_all_machines() -> List[Dict]:
-    """Get all machines with their current status."""
-    machines = []
-    with open(MACHINES_FILE, 'r', newline='') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            machines.append(row)
-    return machines
-
-def get_machine_by_id(machine_id: str) -> Optional[Dict]:
-    """Get a specific machine by its ID."""
-    machines = get_all_machines()
-    for machine in machines:
-        if machine['machine_id'] == machine_id:
-            return machine
-    return None
+    # Storage is written outside _users_lock so lookups never wait on disk
+    with _user_write_lock:
+        with _users_lock:
+            # Check if user already exists
+            if str(user_id) in _users:
+                return
+            
+            # Add new user
+            user = {'user_id': str(user_id), 'username': username or 'Unknown', 'subscribed': 'yes',
+                    'topics': 'all', 'quiet_hours': '', 'room': ''}
+            _update_user(user)
+        _storage.save_user(dict(user))
+        metrics.inc('laundry_storage_writes_total', op='save_user')
+
+def get_user_state(user_id: int) -> Dict:
+    """Get a user's saved conversation state (their place in multi-step flows)."""
+    data = _storage.load_user_state(str(user_id))
+    metrics.inc('laundry_storage_reads_total', op='load_user_state')
+    return json.loads(data) if data else {}
 
-def use_machine(machine_id: str, user_id: int, username: str, duration_minutes: int) -> str:
-    """Mark a machine as in use and return the access code."""
-    machines = get_all_machines()
-    code = generate_code()
+def save_user_states(states: Dict[int, Dict]):
+    """Save the conversation state of several users in one write; an empty state is deleted."""
+    _storage.save_user_states({str(user_id): json.dumps(state) if state else None
+                               for user_id, state in states.items()})
+    metrics.inc('laundry_storage_writes_total', op='save_user_states')
+
+def get_user(user_id: int) -> Optional[Dict]:
+    """Get a registered user."""
+    user = _users.get(str(user_id))
+    return dict(user) if user else None
+
+def get_user_room(user_id: int) -> str:
+    """Get the room a user uses: the one they chose, or the default room."""
+    user = _users.get(str(user_id))
+    return _user_room(user) if user else _default_room
+
+def set_user_room(user_id: int, room_id: str) -> bool:
+    """
+    Move a user to another laundry room, taking them off the waitlists of their old room.
+    Returns False if the user or room is unknown.
+    """
+    if room_id not in _rooms:
+        return False
+    old_room = get_user_room(user_id)
+    if not _change_user(user_id, room=room_id):
+        return False
+    if old_room != room_id:
+        for machine_type in list(_rooms[old_room].waitlists):
+            leave_waitlist(old_room, machine_type, user_id)
+    return True
+
+def set_subscribed(user_id: int, subscribed: bool) -> bool:
+    """Update a user's subscription. Returns False if the user is unknown."""
+    return _change_user(user_id, subscribed='yes' if subscribed else 'no')
+
+def set_topics(user_id: int, topics: List[str]) -> bool:
+    """Set what a user gets notified about ('all', machine types or machine IDs)."""
+    return _change_user(user_id, topics=' '.join(topics) or 'all')
+
+def set_quiet_hours(user_id: int, start_hour: Optional[int], end_hour: Optional[int]) -> bool:
+    """Set hours in which a user gets no broadcasts, or turn them off with None."""
+    quiet_hours = f"{start_hour}-{end_hour}" if start_hour is not None else ''
+    return _change_user(user_id, quiet_hours=quiet_hours)
+
+def get_interested_users(room_id: str, machine_id: str) -> List[int]:
+    """Get the subscribed users of a room who want to hear about one of its machines right now."""
+    room = _rooms.get(room_id)
+    machine = room.machines.get(machine_id) if room else None
+    topics = ['all', machine_id] + ([machine['machine_type']] if machine else [])
+    hour = datetime.now().hour
+    with _users_lock:
+        user_ids = set().union(*(_topic_index.get(f"{room_id}:{topic}", ()) for topic in topics))
+        return [int(user_id) for user_id in user_ids if not _is_quiet(_quiet_hours.get(user_id), hour)]
+
+def load_live_boards():
+    """Load live status boards from storage."""
+    global _boards
+    _boards = {
+        int(b['chat_id']): (int(b['message_id']), b['room_id'] if b['room_id'] in _rooms else _default_room)
+        for b in _storage.load_boards()
+    }
+    metrics.inc('laundry_storage_reads_total', op='load_boards')
+
+def get_live_boards() -> Dict[int, tuple]:
+    """Get all live status boards as chat_id -> (message_id, room_id)."""
+    return dict(_boards)
+
+def set_live_board(chat_id: int, message_id: int, room_id: str):
+    """Add or replace the live status board in a chat, showing the given room."""
+    with _boards_lock:
+        _boards[chat_id] = (message_id, room_id)
+        _storage.save_board(str(chat_id), str(message_id), room_id)
+        metrics.inc('laundry_storage_writes_total', op='save_board')
+
+def remove_live_board(chat_id: int) -> bool:
+    """Remove the live status board in a chat. Returns False if there was none."""
+    with _boards_lock:
+        if _boards.pop(chat_id, None) is None:
+            return False
+        _storage.delete_board(str(chat_id))
+        metrics.inc('laundry_storage_writes_total', op='delete_board')
+        return True
+
+def get_all_machines(room_id: str) -> List[Dict]:
+    """Get all machines in a room with their current status."""
+    room = _rooms.get(room_id)
+    return [dict(m) for m in list(room.machines.values())] if room else []
+
+def get_machine_by_id(room_id: str, machine_id: str) -> Optional[Dict]:
+    """Get a specific machine in a room by its ID."""
+    room = _rooms.get(room_id)
+    machine = room.machines.get(machine_id) if room else None
+    return dict(machine) if machine else None
+
+def _machine_lock(room_id: str, machine_id: str) -> tuple:
+    """Get (room, machine lock) for a machine, or (room, None) if there is no such machine."""
+    room = _rooms.get(room_id)
+    return room, room.machine_locks.get(machine_id) if room else None
+
+def use_machine(room_id: str, machine_id: str, user_id: int, username: str, duration_minutes: int,
+                expected_version: Optional[int] = None) -> Optional[str]:
+    """
+    Mark a free machine as in use and return the access code.
+    Returns None if the machine is not free, or has changed since expected_version.
+    """
+    room, lock = _machine_lock(room_id, machine_id)
+    if lock is None:
+        return None
+    
     end_time = datetime.now() + timedelta(minutes=duration_minutes)
     
     # Update the machine
-    with open(MACHINES_FILE, 'w', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(['machine_id', 'machine_type', 'status', 'user_id', 'username', 'code', 'end_time'])
+    with lock:
+        machine = room.machines[machine_id]
+        if machine['status'] != 'free':
+            return None
+        if expected_version is not None and int(machine['version']) != expected_version:
+            return None
+        
+        with room.waitlist_lock:
+            offer = room.offers.get(machine_id)
+            if offer and offer[0] != str(user_id) and offer[1] > time.time():
+                # Held for someone on the waitlist
+                return None
+            if room.offers.pop(machine_id, None):
+                timers.cancel((room_id, machine_id), 'offer')
+            queue = room.waitlists.get(machine['machine_type'])
+            if queue and str(user_id) in queue:
+                queue.remove(str(user_id))
         
-        for machine in machines:
-            if machine['machine_id'] == machine_id:
-                writer.writerow([
-                    machine_id,
-                    machine['machine_type'],
-                    'in_use',
-                    user_id,
-                    username or 'Unknown',
-                    code,
-                    end_time.isoformat()
-                ])
-            else:
-                writer.writerow([
-                    machine['machine_id'],
-                    machine['machine_type'],
-                    machine['status'],
-                    machine['user_id'],
-                    machine['username'],
-                    machine['code'],
-                    machine['end_time']
-                ])
+        code = _allocate_code(room_id, machine_id)
+        room.end_times[machine_id] = end_time
+        machine = room.machines[machine_id] = dict(
+            machine,
+            status='in_use',
+            user_id=str(user_id),
+            username=username or 'Unknown',
+            code=code,
+            end_time=end_time.isoformat(),
+            finished_at='',
+            version=next_version(machine)
+        )
+        _record_event(room, 'use', machine)
+        with room.heap_lock:
+            heapq.heappush(room.end_time_heaps.setdefault(machine['machine_type'], []), (end_time, machine_id))
+            room.in_use_counts[machine['machine_type']] = room.in_use_counts.get(machine['machine_type'], 0) + 1
     
+    _bump_version(room)
     return code
 
-def collect_machine(machine_id: str, code: str) -> tuple[bool, str]:
+def collect_machine(room_id: str, machine_id: str, code: str) -> tuple[bool, str]:
     """
     Verify code and free the machine.
     Returns (success, message)
     """
-    machine = get_machine_by_id(machine_id)
-    
-    if not machine:
+    room, lock = _machine_lock(room_id, machine_id)
+    if lock is None:
         return False, "Machine not found."
     
-    if machine['status'] != 'in_use':
-        return False, "This machine is not currently in use."
-    
-    if machine['code'] != code:
-        return False, "Incorrect code. Please check and try again."
-    
-    # Free the machine
-    machines = get_all_machines()
-    with open(MACHINES_FILE, 'w', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(['machine_id', 'machine_type', 'status', 'user_id', 'username', 'code', 'end_time'])
+    with lock:
+        machine = room.machines[machine_id]
         
-        for m in machines:
-            if m['machine_id'] == machine_id:
-                writer.writerow([
-                    machine_id,
-                    m['machine_type'],
-                    'free',
-                    '',
-                    '',
-                    '',
-                    ''
-                ])
-            else:
-                writer.writerow([
-                    m['machine_id'],
-                    m['machine_type'],
-                    m['status'],
-                    m['user_id'],
-                    m['username'],
-                    m['code'],
-                    m['end_time']
-                ])
+        if machine['status'] != 'in_use':
+            return False, "This machine is not currently in use."
+        
+        if machine['code'] != code:
+            return False, "Incorrect code. Please check and try again."
+        
+        _free_in_use_machine(room, machine, 'collect')
     
+    _bump_version(room)
     return True, f"Machine {machine_id} is now free. Thank you!"
 
-def get_status_message() -> str:
-    """Generate a status message for all machines."""
-    machines = get_all_machines()
+def release_machine(room_id: str, machine_id: str, code: str) -> Optional[Dict]:
+    """
+    Free a machine whose laundry was never collected, if it is still in use with the
+    given code. Returns the machine as it was, or None if it has been collected since.
+    """
+    room, lock = _machine_lock(room_id, machine_id)
+    if lock is None:
+        return None
+    
+    with lock:
+        machine = room.machines[machine_id]
+        if machine['status'] != 'in_use' or machine['code'] != code:
+            return None
+        _free_in_use_machine(room, machine, 'expire')
+    
+    _bump_version(room)
+    return dict(machine)
+
+def mark_finished(room_id: str, machine_id: str, code: str) -> bool:
+    """
+    Record that a machine's user was told their laundry is ready, so a restart doesn't
+    tell them again. Returns False if it was already recorded, or the machine has been
+    collected since.
+    """
+    room, lock = _machine_lock(room_id, machine_id)
+    if lock is None:
+        return False
+    
+    with lock:
+        machine = room.machines[machine_id]
+        if machine['status'] != 'in_use' or machine['code'] != code or machine['finished_at']:
+            return False
+        machine = room.machines[machine_id] = dict(machine, finished_at=datetime.now().isoformat(timespec='seconds'))
+        _record_event(room, 'finish', machine)
+    return True
+
+def _free_in_use_machine(room: Room, machine: Dict, event: str):
+    """Free a machine in use and cancel its timers. Call with the machine's lock held."""
+    machine_id = machine['machine_id']
+    room.machines[machine_id] = dict(machine, status='free', user_id='', username='', code='', end_time='',
+                                     finished_at='', version=next_version(machine))
+    _codes.pop(machine['code'], None)
+    room.end_times.pop(machine_id, None)
+    with room.heap_lock:
+        machine_type = machine['machine_type']
+        room.in_use_counts[machine_type] -= 1
+        # The heap entry is left behind; rebuilding once stale entries outnumber live
+        # ones keeps the heap within twice the machines in use, at O(1) amortized cost
+        heap = room.end_time_heaps.get(machine_type, [])
+        if len(heap) > 2 * room.in_use_counts[machine_type]:
+            heap[:] = [entry for entry in heap if room.end_times.get(entry[1]) == entry[0]]
+            heapq.heapify(heap)
+    # Finish notification, reminders and automatic release
+    timers.cancel((room.room_id, machine_id))
+    # Recorded with the user and code it had, for the history
+    _record_event(room, event, machine)
+
+def join_waitlist(room_id: str, machine_type: str, user_id: int) -> int:
+    """Add a user to the end of a machine type's waitlist in a room. Returns their position (1 = next)."""
+    room = _rooms[room_id]
+    with room.waitlist_lock:
+        queue = room.waitlists.setdefault(machine_type, deque())
+        if str(user_id) not in queue:
+            queue.append(str(user_id))
+        position = queue.index(str(user_id)) + 1
+    
+    # The status view shows how many are waiting
+    _bump_version(room)
+    return position
+
+def leave_waitlist(room_id: str, machine_type: str, user_id: int) -> bool:
+    """Remove a user from a waitlist. Returns False if they weren't on it."""
+    room = _rooms[room_id]
+    with room.waitlist_lock:
+        queue = room.waitlists.get(machine_type)
+        if not queue or str(user_id) not in queue:
+            return False
+        queue.remove(str(user_id))
+    
+    _bump_version(room)
+    return True
+
+def offer_machine(room_id: str, machine_id: str) -> Optional[int]:
+    """
+    Hold a free machine for the next user on its type's waitlist, for CLAIM_TIMEOUT seconds.
+    Returns that user's ID, or None if nobody is waiting or the machine is no longer free.
+    """
+    room, lock = _machine_lock(room_id, machine_id)
+    if lock is None:
+        return None
     
-    message = "🏠 *Laundry Room Status*\n\n"
+    with lock:
+        machine = room.machines[machine_id]
+        if machine['status'] != 'free':
+            return None
+        with room.waitlist_lock:
+            room.offers.pop(machine_id, None)
+            queue = room.waitlists.get(machine['machine_type'])
+            if not queue:
+                return None
+            user_id = queue.popleft()
+            room.offers[machine_id] = (user_id, time.time() + CLAIM_TIMEOUT)
+    
+    _bump_version(room)
+    return int(user_id)
+
+def release_offer(room_id: str, machine_id: str, user_id: int) -> bool:
+    """
+    Stop holding a machine for a user (they passed, or didn't claim it in time).
+    Returns False if the machine is no longer held for them, e.g. because they took it.
+    """
+    room = _rooms[room_id]
+    with room.waitlist_lock:
+        offer = room.offers.get(machine_id)
+        if not offer or offer[0] != str(user_id):
+            return False
+        del room.offers[machine_id]
+        timers.cancel((room_id, machine_id), 'offer')
+    
+    _bump_version(room)
+    return True
+
+def get_offer(room_id: str, machine_id: str) -> Optional[int]:
+    """Get the user a free machine is being held for, if any."""
+    offer = _rooms[room_id].offers.get(machine_id)
+    return int(offer[0]) if offer else None
+
+def get_machine_history(room_id: str, machine_id: Optional[str] = None, limit: Optional[int] = 20) -> List[Dict]:
+    """Get a room's latest machine events (uses and collections), oldest first, for one machine or all (limit=None for every event)."""
+    flush_machines(room_id)
+    events = _rooms[room_id].storage.load_history(machine_id, limit)
+    metrics.inc('laundry_storage_reads_total', op='load_history')
+    return events
+
+def _earliest_end(room: Room, machine_type: str) -> Optional[tuple]:
+    """The (end_time, machine_id) of the machine of a type that finishes first. Call with the room's heap_lock held."""
+    heap = room.end_time_heaps.get(machine_type, [])
+    while heap:
+        end_time, machine_id = heap[0]
+        if room.end_times.get(machine_id) == end_time:
+            return heap[0]
+        heapq.heappop(heap)
+    return None
+
+def next_free_time(room_id: str, machine_type: str, position: int = 1) -> Optional[tuple]:
+    """
+    Estimate when a machine of a type will be free for the user at the given waitlist
+    position (1 = next). Returns (end_time, machine_id); machine_id is None if enough
+    machines are free now. Returns None if the room has no machines of the type, or the
+    position is too far down the line to estimate.
+    """
+    room = _rooms[room_id]
+    with room.heap_lock:
+        if not room.machine_counts.get(machine_type):
+            return None
+        free = room.machine_counts[machine_type] - room.in_use_counts.get(machine_type, 0)
+        if position <= free:
+            return datetime.now(), None
+        if position - free == 1:
+            return _earliest_end(room, machine_type)
+        # Further down the line, take the n-th earliest end time
+        return _nth_earliest_end(room, machine_type, position - free)
+
+def _nth_earliest_end(room: Room, machine_type: str, n: int) -> Optional[tuple]:
+    """
+    The n-th earliest (end_time, machine_id) of machines of a type in use, or None if
+    fewer are in use. Walks the heap from the top, visiting O(n) entries (at most half
+    the heap is stale), so it takes O(n log n). Call with the room's heap_lock held.
+    """
+    heap = room.end_time_heaps.get(machine_type, [])
+    # Heap entries still to look at, with their index in the heap
+    frontier = [(heap[0], 0)] if heap else []
+    while frontier:
+        entry, index = heapq.heappop(frontier)
+        if room.end_times.get(entry[1]) == entry[0]:
+            n -= 1
+            if n == 0:
+                return entry
+        for child in (2 * index + 1, 2 * index + 2):
+            if child < len(heap):
+                heapq.heappush(frontier, (heap[child], child))
+    return None
+
+def get_waitlist_length(room_id: str, machine_type: str) -> int:
+    room = _rooms[room_id]
+    with room.waitlist_lock:
+        return len(room.waitlists.get(machine_type, ()))
+
+def collect_by_code(code: str) -> tuple[bool, str, Optional[str], Optional[str]]:
+    """
+    Free whichever machine, in any room, has the given collection code.
+    Returns (success, message, room_id, machine_id); the IDs are None if no machine has the code.
+    """
+    key = _codes.get(code)
+    if not key:
+        return False, "Invalid code or machine not in use.", None, None
+    room_id, machine_id = key
+    success, message = collect_machine(room_id, machine_id, code)
+    return success, message, room_id, machine_id
+
+def _status_line(room: Room, machine: Dict, now: datetime) -> str:
+    status_emoji = "✅"
+    status_text = "Free"
+    
+    if machine['status'] == 'free' and machine['machine_id'] in room.offers:
+        status_emoji = "🔒"
+        status_text = "Held for next in line"
+    elif machine['status'] == 'in_use':
+        end_time = room.end_times.get(machine['machine_id'])
+        if end_time is None:
+            status_emoji = "⏳"
+            status_text = "In Use"
+        elif end_time > now:
+            minutes_left = int((end_time - now).total_seconds() / 60)
+            status_emoji = "⏳"
+            status_text = f"In Use ({minutes_left} min left)"
+        else:
+            status_emoji = "🧺"
+            status_text = "Finished (Ready to collect)"
+    
+    return f"{status_emoji} {machine['machine_id']}: {status_text}\n"
+
+def _next_free_line(room_id: str, machine_type: str, now: datetime) -> str:
+    """A line saying when the next machine of a type frees up, if none is free now."""
+    next_free = next_free_time(room_id, machine_type)
+    if next_free is None or next_free[1] is None:
+        return ""
+    
+    end_time, machine_id = next_free
+    if end_time > now:
+        line = f"⏭ Next free: {end_time.strftime('%H:%M')} ({machine_id})"
+    else:
+        line = f"⏭ Next free: when {machine_id} is collected"
+    waiting = get_waitlist_length(room_id, machine_type)
+    if waiting:
+        line += f", {waiting} waiting"
+    return line + "\n"
+
+def get_status_message(room_id: str) -> str:
+    """Generate a status message for a room's machines (cached until the room changes or the minute ends)."""
+    room = _rooms[room_id]
+    cache_key = (room.state_version, int(time.time() // 60))
+    cached = room.status_cache
+    if cached and cached[0] == cache_key:
+        return cached[1]
+    
+    machines = list(room.machines.values())
+    now = datetime.now()
+    
+    message = f"🏠 *{escape_markdown(room.name)} Status*\n\n"
     
     # Washing Machines
     message += "🌀 *Washing Machines:*\n"
     for machine in machines:
         if machine['machine_type'] == 'washing_machine':
-            status_emoji = "✅"
-            status_text = "Free"
-            
-            if machine['status'] == 'in_use' and machine['end_time']:
-                try:
-                    end_time = datetime.fromisoformat(machine['end_time'])
-                    time_left = end_time - datetime.now()
-                    if time_left.total_seconds() > 0:
-                        minutes_left = int(time_left.total_seconds() / 60)
-                        status_emoji = "⏳"
-                        status_text = f"In Use ({minutes_left} min left)"
-                    else:
-                        status_emoji = "🧺"
-                        status_text = "Finished (Ready to collect)"
-                except:
-                    status_emoji = "⏳"
-                    status_text = "In Use"
-            
-            message += f"{status_emoji} {machine['machine_id']}: {status_text}\n"
+            message += _status_line(room, machine, now)
+    message += _next_free_line(room_id, 'washing_machine', now)
     
     # Dryers
     message += "\n🔥 *Dryers:*\n"
     for machine in machines:
         if machine['machine_type'] == 'dryer':
-            status_emoji = "✅"
-            status_text = "Free"
-            
-            if machine['status'] == 'in_use' and machine['end_time']:
-                try:
-                    end_time = datetime.fromisoformat(machine['end_time'])
-                    time_left = end_time - datetime.now()
-                    if time_left.total_seconds() > 0:
-                        minutes_left = int(time_left.total_seconds() / 60)
-                        status_emoji = "⏳"
-                        status_text = f"In Use ({minutes_left} min left)"
-                    else:
-                        status_emoji = "🧺"
-                        status_text = "Finished (Ready to collect)"
-                except:
-                    status_emoji = "⏳"
-                    status_text = "In Use"
-            
-            message += f"{status_emoji} {machine['machine_id']}: {status_text}\n"
+            message += _status_line(room, machine, now)
+    message += _next_free_line(room_id, 'dryer', now)
     
+    room.status_cache = (cache_key, message)
     return message
 
 def check_finished_machines() -> List[Dict]:
-    """Check for machines that have finished and return their info."""
+    """Check for machines in any room that have finished and return their info (with room_id)."""
     finished = []
-    machines = get_all_machines()
     now = datetime.now()
     
-    for machine in machines:
-        if machine['status'] == 'in_use' and machine['end_time']:
-            try:
-                end_time = datetime.fromisoformat(machine['end_time'])
-                if now >= end_time:
-                    finished.append(machine)
-            except:
-                pass
+    for room_id in list(_rooms):
+        for machine in get_all_machines(room_id):
+            if machine['status'] == 'in_use' and machine['end_time']:
+                try:
+                    end_time = datetime.fromisoformat(machine['end_time'])
+                    if now >= end_time:
+                        finished.append(dict(machine, room_id=room_id))
+                except:
+                    pass
     
     return finished
+
+def check_running_machines() -> List[Dict]:
+    """Check for machines in any room that are still running and return their info (with room_id)."""
+    running = []
+    now = datetime.now()
+    
+    for room_id in list(_rooms):
+        for machine in get_all_machines(room_id):
+            if machine['status'] == 'in_use' and machine['end_time']:
+                try:
+                    end_time = datetime.fromisoformat(machine['end_time'])
+                    if now < end_time:
+                        running.append(dict(machine, room_id=room_id))
+                except:
+                    pass
+    
+    return running
@@ -0,0 +1,86 @@
+import asyncio
+import time
+from typing import Dict
+
+import async_data_manager as adm
+import broadcaster
+import data_manager as dm
+import metrics
+
+# How often to check whether the live status boards need updating, in seconds.
+# Boards are only edited when the rendered status has actually changed.
+REFRESH_INTERVAL = 5
+
+# chat_id -> status text last shown on that chat's board
+_last_text: Dict[int, str] = {}
+# room_id -> (state version, minute) the room's boards were last brought up to date for
+_last_keys: Dict[str, tuple] = {}
+_refreshing = False
+
+def board_text(room_id: str) -> str:
+    return dm.get_status_message(room_id) + "\n_Updates automatically_"
+
+async def post_board(bot, chat_id: int, room_id: str, pin: bool = True) -> int:
+    """Post a live status board for a room in a chat, replacing any previous one. Returns its message ID."""
+    text = board_text(room_id)
+    message = await bot.send_message(chat_id=chat_id, text=text, parse_mode='Markdown')
+    if pin:
+        try:
+            await message.pin(disable_notification=True)
+        except Exception as e:
+            print(f"Could not pin live status in chat {chat_id}: {e}")
+
+    await adm.set_live_board(chat_id, message.message_id, room_id)
+    _last_text[chat_id] = text
+    return message.message_id
+
+def forget_board(chat_id: int):
+    _last_text.pop(chat_id, None)
+
+async def refresh_boards(context):
+    """Job queue callback: edit every live status board whose text has changed."""
+    global _refreshing
+    if _refreshing:
+        return
+
+    _refreshing = True
+    try:
+        # Only rooms with boards are looked at, and only those that changed are rendered
+        minute = int(time.time() // 60)
+        boards_by_room: Dict[str, list] = {}
+        for chat_id, (message_id, room_id) in dm.get_live_boards().items():
+            boards_by_room.setdefault(room_id, []).append((chat_id, message_id))
+        keys = {room_id: (dm.get_state_version(room_id), minute) for room_id in boards_by_room}
+
+        boards = []
+        for room_id, room_boards in boards_by_room.items():
+            if _last_keys.get(room_id) == keys[room_id]:
+                continue
+            text = board_text(room_id)
+            boards += [(room_id, chat_id, message_id, text) for chat_id, message_id in room_boards
+                       if _last_text.get(chat_id) != text]
+        semaphore = asyncio.Semaphore(broadcaster.MAX_CONCURRENCY)
+        # Rooms with a board that failed for a transient reason, to try again next time
+        failed_rooms = set()
+
+        async def update(room_id, chat_id, message_id, text):
+            async with semaphore:
+                try:
+                    await broadcaster.edit(context.bot, chat_id, message_id, text, parse_mode='Markdown')
+                    _last_text[chat_id] = text
+                    metrics.inc('laundry_live_board_edits_total')
+                except Exception as e:
+                    error = str(e).lower()
+                    if (broadcaster.is_permanent_failure(e) or "message to edit not found" in error
+                            or "can't be edited" in error):
+                        # The board was deleted, or the bot was blocked or removed from the chat
+                        await adm.remove_live_board(chat_id)
+                        forget_board(chat_id)
+                    else:
+                        failed_rooms.add(room_id)
+                    print(f"Could not update live status in chat {chat_id}: {e}")
+
+        await asyncio.gather(*(update(*board) for board in boards))
+        _last_keys.update({room_id: key for room_id, key in keys.items() if room_id not in failed_rooms})
+    finally:
+        _refreshing = False
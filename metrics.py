@@ -0,0 +1,144 @@
+import threading
+import time
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+
+# Metrics are only collected once enable() is called; until then every recording
+# function returns straight away, so instrumentation costs a single flag check.
+enabled = False
+
+# Latency histogram buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_lock = threading.Lock()
+# (name, labels) -> value
+_counters: Dict[Tuple[str, tuple], float] = {}
+# (name, labels) -> [bucket counts..., sum, count]
+_histograms: Dict[Tuple[str, tuple], list] = {}
+_help: Dict[str, str] = {
+    'laundry_handler_seconds': "Time spent handling updates, by handler",
+    'laundry_storage_reads_total': "Reads from the storage backend, by operation",
+    'laundry_storage_writes_total': "Writes to the storage backend, by operation",
+    'laundry_telegram_requests_total': "Telegram Bot API calls, by method",
+    'laundry_telegram_failures_total': "Failed Telegram Bot API calls, by method",
+    'laundry_job_lag_seconds': "Delay between when a job was due and when it ran",
+    'laundry_live_board_edits_total': "Edits made to live status boards",
+    'laundry_updates_dropped_total': "Button presses and messages ignored, by reason",
+    'laundry_users_unsubscribed_total': "Users unsubscribed because they can no longer be messaged",
+}
+
+def enable():
+    global enabled
+    enabled = True
+
+def inc(name: str, value: float = 1, **labels):
+    """Increase a counter."""
+    if not enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name: str, value: float, **labels):
+    """Record a value in a histogram."""
+    if not enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(BUCKETS) + 2)
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram[i] += 1
+                break
+        histogram[-2] += value
+        histogram[-1] += 1
+
+def track_handler(func):
+    """Decorate an async handler to record its latency."""
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        if not enabled:
+            return await func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            observe('laundry_handler_seconds', time.perf_counter() - start, handler=func.__name__)
+    return wrapper
+
+def _format_labels(labels: tuple, **extra) -> str:
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in items) + "}"
+
+def render() -> str:
+    """Render all metrics in the Prometheus text format."""
+    lines = []
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((key, list(values)) for key, values in _histograms.items())
+
+    seen = set()
+    for (name, labels), value in counters:
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# HELP {name} {_help.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+
+    for (name, labels), values in histograms:
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# HELP {name} {_help.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for bound, count in zip(BUCKETS, values):
+            cumulative += count
+            lines.append(f"{name}_bucket{_format_labels(labels, le=bound)} {cumulative}")
+        lines.append(f"{name}_bucket{_format_labels(labels, le='+Inf')} {values[-1]}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {values[-2]}")
+        lines.append(f"{name}_count{_format_labels(labels)} {values[-1]}")
+
+    return "\n".join(lines) + "\n"
+
+def format_stats() -> str:
+    """Summarize the metrics as a short chat message."""
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((key, list(values)) for key, values in _histograms.items())
+
+    lines = ["📈 Bot statistics", ""]
+    for (name, labels), values in histograms:
+        label = ", ".join(str(value) for _, value in labels)
+        average = values[-2] / values[-1] * 1000 if values[-1] else 0
+        lines.append(f"{name} [{label}]: {values[-1]} calls, avg {average:.1f} ms")
+    for (name, labels), value in counters:
+        label = ", ".join(str(value) for _, value in labels)
+        lines.append(f"{name} [{label}]: {value:g}")
+    return "\n".join(lines)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_http_server(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serve /metrics on the given port from a background thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,113 @@
+import asyncio
+from copy import deepcopy
+from typing import Dict, Optional
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import async_data_manager as adm
+
+# Seconds between the application's persistence runs. The states that changed in
+# that time are written together, in one batch.
+UPDATE_INTERVAL = 5
+
+class UserStatePersistence(BasePersistence):
+    """
+    Keeps each user's user_data (where they are in a multi-step flow, e.g. entering a
+    custom time or a collection code) across restarts, in data_manager's storage.
+
+    Only user_data is stored. A user's state is loaded the first time they send an
+    update after a restart, and only states that actually changed are written.
+    """
+
+    def __init__(self, update_interval: float = UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        # user_id -> state as last loaded or saved, for users seen since the start
+        self._saved: Dict[int, dict] = {}
+        # user_id -> state waiting to be written (empty to delete it)
+        self._dirty: Dict[int, dict] = {}
+        self._write_task: Optional[asyncio.Task] = None
+        self._write_lock = asyncio.Lock()
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        # Loaded per user on first access instead, in refresh_user_data
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        """Load a user's saved state the first time they are seen."""
+        if user_id in self._saved:
+            return
+        self._saved[user_id] = {}
+        state = await adm.get_user_state(user_id)
+        self._saved[user_id] = deepcopy(state)
+        for key, value in state.items():
+            user_data.setdefault(key, value)
+
+    async def update_user_data(self, user_id: int, data: dict):
+        # Called for every user who sent an update, whether or not their state changed
+        if self._saved.get(user_id, {}) == data:
+            return
+        # data is the live user_data dict, so keep a copy to compare against later
+        data = deepcopy(data)
+        self._saved[user_id] = data
+        self._dirty[user_id] = data
+        if self._write_task is None:
+            self._write_task = asyncio.get_running_loop().create_task(self._write_batch())
+
+    async def drop_user_data(self, user_id: int):
+        await self.update_user_data(user_id, {})
+
+    async def _write_batch(self):
+        # Let the rest of this persistence run join the batch
+        await asyncio.sleep(0)
+        self._write_task = None
+        await self.flush()
+
+    async def flush(self):
+        """Write the states that changed."""
+        async with self._write_lock:
+            if not self._dirty:
+                return
+            states, self._dirty = self._dirty, {}
+            try:
+                await adm.save_user_states(states)
+            except Exception as e:
+                print(f"Could not save conversation state: {e}")
+                # Retried with the next batch, unless changed again since
+                for user_id, state in states.items():
+                    self._dirty.setdefault(user_id, state)
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]):
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        pass
+
+    async def update_bot_data(self, data: dict):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
@@ -0,0 +1,142 @@
+import time
+from collections import OrderedDict
+from functools import wraps
+from typing import Hashable
+
+import metrics
+from broadcaster import TokenBucket
+
+# Limits on what a single user can make the bot do, checked before a button press or
+# message reaches its handler, so mashing a button or a client replaying callbacks
+# doesn't turn into storage reads and Telegram calls.
+
+# Each user can press buttons / send messages in bursts of USER_BURST, then USER_RATE per second
+USER_RATE = 1.0
+USER_BURST = 10
+
+# The same button on the same message pressed again within this many seconds is ignored,
+# unless the message has changed since (see message_changed)
+DUPLICATE_WINDOW = 2.0
+# Buttons that change state (reserving a machine) stay ignored for the whole window,
+# even once their message has changed: a double tap must not reserve twice
+STATE_CHANGING_BUTTONS = ('time_', 'custom_')
+
+# Wrong collection codes a user can enter in a row, then one more every CODE_ATTEMPT_SECONDS
+CODE_ATTEMPTS = 5
+CODE_ATTEMPT_SECONDS = 180
+
+# Upper bound on users tracked per table, however many are active at once
+MAX_TRACKED_USERS = 100000
+
+class BucketTable:
+    """
+    A token bucket per key (user), kept in least recently used order. Buckets that have
+    refilled are the same as new ones, so they are forgotten as the table is used; memory
+    only grows with the number of users active within a refill period.
+    """
+
+    def __init__(self, rate: float, capacity: float, limit: int = MAX_TRACKED_USERS):
+        self.rate = rate
+        self.capacity = capacity
+        self.limit = limit
+        self._buckets: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def get(self, key: Hashable) -> TokenBucket:
+        """Get the key's bucket, creating it if needed, and mark it as just used."""
+        bucket = self._buckets.pop(key, None)
+        self._evict()
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.capacity)
+        self._buckets[key] = bucket
+        return bucket
+
+    def peek(self, key: Hashable) -> TokenBucket:
+        """Get the key's bucket without creating or reordering it (a full one if it isn't tracked)."""
+        return self._buckets.get(key) or TokenBucket(self.rate, self.capacity)
+
+    def _evict(self):
+        # Looks at the least recently used buckets only, so each call does O(1) work on average
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            if len(self._buckets) < self.limit and not bucket.is_full():
+                break
+            del self._buckets[key]
+
+_user_buckets = BucketTable(USER_RATE, USER_BURST)
+_code_buckets = BucketTable(1 / CODE_ATTEMPT_SECONDS, CODE_ATTEMPTS)
+
+# (user_id, message) -> (callback data, when it was pressed) for the last press, oldest first
+_recent_callbacks: OrderedDict = OrderedDict()
+
+def allow(user_id: int) -> bool:
+    """Count an update from the user; False if they are over their rate."""
+    return _user_buckets.get(user_id).try_take()
+
+def is_duplicate(user_id: int, message: Hashable, data: str) -> bool:
+    """
+    Record a button press; True if the same button was the last one pressed on the
+    message, within DUPLICATE_WINDOW and without the message changing since.
+    """
+    now = time.monotonic()
+    # Forget presses that have left the window
+    while _recent_callbacks:
+        pressed = next(iter(_recent_callbacks.values()))[1]
+        if now - pressed < DUPLICATE_WINDOW and len(_recent_callbacks) < MAX_TRACKED_USERS:
+            break
+        _recent_callbacks.popitem(last=False)
+
+    key = (user_id, message)
+    last = _recent_callbacks.get(key)
+    if last is not None and last[0] == data:
+        return True
+    _recent_callbacks.pop(key, None)
+    _recent_callbacks[key] = (data, now)
+    return False
+
+def message_changed(user_id: int, message: Hashable):
+    """
+    Call when a message the user presses buttons on now shows something else, so a
+    press on the new screen isn't taken for a repeat (e.g. Status, Back, Status).
+    """
+    last = _recent_callbacks.get((user_id, message))
+    if last is not None and not last[0].startswith(STATE_CHANGING_BUTTONS):
+        del _recent_callbacks[(user_id, message)]
+
+def code_lockout(user_id: int) -> float:
+    """Seconds until the user may enter another collection code (0 if they can now)."""
+    return _code_buckets.peek(user_id).wait_time()
+
+def code_failed(user_id: int):
+    """Count a wrong collection code against the user."""
+    _code_buckets.get(user_id).try_take()
+
+def limit_user(func):
+    """
+    Decorate a handler to drop repeated button presses and updates from users over their
+    rate. Dropped button presses are still answered, so the client stops waiting.
+    """
+    @wraps(func)
+    async def wrapper(update, context):
+        user = update.effective_user
+        query = update.callback_query
+        if user is None:
+            return await func(update, context)
+
+        if query is not None:
+            message = query.message.message_id if query.message else query.inline_message_id
+            if is_duplicate(user.id, message, query.data):
+                metrics.inc('laundry_updates_dropped_total', reason='duplicate')
+                await query.answer()
+                return
+
+        if not allow(user.id):
+            metrics.inc('laundry_updates_dropped_total', reason='rate_limit')
+            if query is not None:
+                await query.answer("⏳ Slow down a little, please.")
+            return
+
+        return await func(update, context)
+    return wrapper
@@ -0,0 +1,587 @@
+import csv
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional
+
+MACHINE_FIELDS = ['machine_id', 'machine_type', 'status', 'user_id', 'username', 'code', 'end_time', 'finished_at',
+                  'version']
+# Defaults for machine fields added after the first release
+MACHINE_DEFAULTS = {'finished_at': '', 'version': '0'}
+USER_FIELDS = ['user_id', 'username', 'subscribed', 'topics', 'quiet_hours', 'room']
+# Defaults for user fields added after the first release
+USER_DEFAULTS = {'topics': 'all', 'quiet_hours': '', 'room': ''}
+BOARD_FIELDS = ['chat_id', 'message_id', 'room_id']
+# A user's conversation state (the bot's user_data) as JSON; empty once deleted
+USER_STATE_FIELDS = ['user_id', 'data']
+# Defaults for board fields added after the first release
+BOARD_DEFAULTS = {'room_id': ''}
+# A machine event: 'use' (with the new user, code and end time), 'finish' (its user was
+# told the laundry is ready), or 'collect' or 'expire' (released without being
+# collected), with the user and code the machine had. Replaying events in order
+# rebuilds machine state.
+EVENT_FIELDS = ['time', 'event', 'machine_id', 'user_id', 'username', 'code', 'end_time']
+
+def _write_csv_atomic(path: str, fields: List[str], rows: Iterable[Dict]):
+    """Write a CSV file via a temp file and rename, so a crash never leaves it half-written."""
+    tmp_file = f"{path}.tmp"
+    with open(tmp_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+
+def _read_csv(path: str, defaults: Dict[str, str]) -> tuple:
+    """Read a CSV file, filling in columns it predates. Returns (rows, whether its header is outdated)."""
+    with open(path, 'r', newline='') as f:
+        reader = csv.DictReader(f)
+        rows = list(reader)
+        fields = reader.fieldnames or []
+    for row in rows:
+        # Values beyond the header (a row merged with a torn one by an older version)
+        row.pop(None, None)
+        for field, default in defaults.items():
+            if row.get(field) is None:
+                row[field] = default
+    return rows, any(field not in fields for field in defaults)
+
+def next_version(machine: Dict) -> str:
+    """The version a machine gets when it is used or freed; kept with it, so it survives restarts."""
+    return str(int(machine.get('version') or 0) + 1)
+
+def apply_event(machines: Dict[str, Dict], event: Dict):
+    """Apply a machine event to machine state (machine_id -> row)."""
+    machine = machines.get(event['machine_id'])
+    if machine is None:
+        return
+    if event['event'] == 'use':
+        machines[event['machine_id']] = dict(
+            machine,
+            status='in_use',
+            user_id=event['user_id'],
+            username=event['username'],
+            code=event['code'],
+            end_time=event['end_time'],
+            finished_at='',
+            version=next_version(machine)
+        )
+    elif event['event'] == 'finish':
+        if machine['status'] == 'in_use' and machine['code'] == event['code']:
+            machines[event['machine_id']] = dict(machine, finished_at=event['time'])
+    elif event['event'] in ('collect', 'expire'):
+        machines[event['machine_id']] = dict(machine, status='free', user_id='', username='', code='', end_time='',
+                                             finished_at='', version=next_version(machine))
+
+def _truncate_partial_line(path: str):
+    """Cut off a half-written last line left by a crash, so appends start on a fresh line."""
+    with open(path, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b'\n'):
+            f.truncate(data.rfind(b'\n') + 1)
+
+class MachineStorage:
+    """Where data_manager persists the machines of one laundry room, and their events."""
+
+    def init(self, machines: List[Dict]):
+        """Create the store if needed, and add any of the given (free) machines it doesn't have yet."""
+        raise NotImplementedError
+
+    def load_machines(self) -> List[Dict]:
+        raise NotImplementedError
+
+    def save_machines(self, machines: List[Dict], events: List[Dict]):
+        """Persist machine state; machines is every machine, events the changes since the last save, in order."""
+        raise NotImplementedError
+
+    def load_history(self, machine_id: Optional[str] = None, limit: Optional[int] = None) -> List[Dict]:
+        """Load past machine events, oldest first: the last limit of them, for one machine or all."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class Storage:
+    """Where data_manager persists users and live status boards."""
+
+    def init(self):
+        """Create the store if needed."""
+        raise NotImplementedError
+
+    def load_users(self) -> List[Dict]:
+        raise NotImplementedError
+
+    def save_user(self, user: Dict):
+        """Persist a new or updated user."""
+        raise NotImplementedError
+
+    def compact_users(self):
+        """Reclaim space used by old user records, if the backend keeps any."""
+
+    def load_user_state(self, user_id: str) -> Optional[str]:
+        """Load a user's conversation state (JSON), or None if there is none."""
+        raise NotImplementedError
+
+    def save_user_states(self, states: Dict[str, Optional[str]]):
+        """Save the conversation state (JSON) of several users at once; None deletes a user's state."""
+        raise NotImplementedError
+
+    def load_boards(self) -> List[Dict]:
+        """Load the live status boards (chat_id, message_id, room_id)."""
+        raise NotImplementedError
+
+    def save_board(self, chat_id: str, message_id: str, room_id: str):
+        raise NotImplementedError
+
+    def delete_board(self, chat_id: str):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class CSVMachineStorage(MachineStorage):
+    """Stores a room's machines as a snapshot (machines.csv) plus an append-only journal of events."""
+
+    # Once the journal holds this many events, a new snapshot is written and the
+    # events are moved to the history file
+    JOURNAL_COMPACT_ROWS = 1000
+
+    def __init__(self, machines_file: str, journal_file: str, history_file: str):
+        self.machines_file = machines_file
+        self.journal_file = journal_file
+        self.history_file = history_file
+        self._lock = threading.Lock()
+        self._journal_rows = 0
+
+    def init(self, machines: List[Dict]):
+        if not os.path.exists(self.machines_file):
+            _write_csv_atomic(self.machines_file, MACHINE_FIELDS, machines)
+        else:
+            rows, outdated = _read_csv(self.machines_file, MACHINE_DEFAULTS)
+            known = {row['machine_id'] for row in rows}
+            added = [machine for machine in machines if machine['machine_id'] not in known]
+            if added or outdated:
+                # Added to the snapshot, so journal events for them can be replayed
+                _write_csv_atomic(self.machines_file, MACHINE_FIELDS, rows + added)
+        for path in [self.journal_file, self.history_file]:
+            if not os.path.exists(path):
+                _write_csv_atomic(path, EVENT_FIELDS, [])
+
+    def _load_journal(self) -> List[Dict]:
+        if not os.path.exists(self.journal_file):
+            return []
+        _truncate_partial_line(self.journal_file)
+        with open(self.journal_file, 'r', newline='') as f:
+            return list(csv.DictReader(f))
+
+    def load_machines(self) -> List[Dict]:
+        """Load the last snapshot and replay the journal over it."""
+        rows, _ = _read_csv(self.machines_file, MACHINE_DEFAULTS)
+        machines = {row['machine_id']: row for row in rows}
+        with self._lock:
+            events = self._load_journal()
+            for event in events:
+                apply_event(machines, event)
+            self._journal_rows = len(events)
+        return list(machines.values())
+
+    def save_machines(self, machines: List[Dict], events: List[Dict]):
+        # One fsync per batch of events
+        with self._lock:
+            with open(self.journal_file, 'a', newline='') as f:
+                csv.DictWriter(f, fieldnames=EVENT_FIELDS).writerows(events)
+                f.flush()
+                os.fsync(f.fileno())
+            self._journal_rows += len(events)
+            if self._journal_rows >= self.JOURNAL_COMPACT_ROWS:
+                self._compact(machines)
+
+    def _compact(self, machines: List[Dict]):
+        """
+        Write a new snapshot and move the journal to the history file. Call with _lock
+        held. Replaying events is idempotent, so a crash part way through leaves state
+        intact (at worst, some events appear twice in history).
+        """
+        _write_csv_atomic(self.machines_file, MACHINE_FIELDS, machines)
+        events = self._load_journal()
+        with open(self.history_file, 'a', newline='') as f:
+            csv.DictWriter(f, fieldnames=EVENT_FIELDS).writerows(events)
+            f.flush()
+            os.fsync(f.fileno())
+        _write_csv_atomic(self.journal_file, EVENT_FIELDS, [])
+        self._journal_rows = 0
+
+    def load_history(self, machine_id: Optional[str] = None, limit: Optional[int] = None) -> List[Dict]:
+        events = []
+        with self._lock:
+            if os.path.exists(self.history_file):
+                with open(self.history_file, 'r', newline='') as f:
+                    events.extend(csv.DictReader(f))
+            events.extend(self._load_journal())
+        if machine_id:
+            events = [event for event in events if event['machine_id'] == machine_id]
+        return events[-limit:] if limit else events
+
+class CSVStorage(Storage):
+    """
+    Stores users in an append-only users.csv, conversation state in an append-only
+    user_state.csv, and live status boards in a small CSV file.
+    """
+
+    # users.csv and user_state.csv are append-only logs (the last row for a user wins);
+    # they are compacted once they hold more than USERS_COMPACT_RATIO rows per user
+    USERS_COMPACT_RATIO = 2
+    USERS_COMPACT_MIN_ROWS = 100
+
+    def __init__(self, users_file: str, boards_file: str, state_file: str):
+        self.users_file = users_file
+        self.boards_file = boards_file
+        self.state_file = state_file
+        self._users_lock = threading.Lock()
+        self._users: Dict[str, Dict] = {}
+        self._user_log_rows = 0
+        self._boards_lock = threading.Lock()
+        self._boards: Dict[str, Dict] = {}
+        self._states_lock = threading.Lock()
+        # user_id -> state, read from user_state.csv when first needed
+        self._states: Optional[Dict[str, str]] = None
+        self._state_log_rows = 0
+
+    def init(self):
+        if not os.path.exists(self.users_file):
+            _write_csv_atomic(self.users_file, USER_FIELDS, [])
+        if not os.path.exists(self.boards_file):
+            _write_csv_atomic(self.boards_file, BOARD_FIELDS, [])
+        if not os.path.exists(self.state_file):
+            _write_csv_atomic(self.state_file, USER_STATE_FIELDS, [])
+
+    def load_users(self) -> List[Dict]:
+        # A crash part way through an append leaves a half-written last row
+        _truncate_partial_line(self.users_file)
+        rows, outdated = _read_csv(self.users_file, USER_DEFAULTS)
+        users = {row['user_id']: row for row in rows}
+        with self._users_lock:
+            self._users = {user_id: dict(user) for user_id, user in users.items()}
+            self._user_log_rows = len(rows)
+        if outdated:
+            # Rewrite with the current columns before appending any rows
+            self.compact_users()
+        return list(users.values())
+
+    def save_user(self, user: Dict):
+        with self._users_lock:
+            with open(self.users_file, 'a', newline='') as f:
+                csv.DictWriter(f, fieldnames=USER_FIELDS).writerow(user)
+                f.flush()
+                os.fsync(f.fileno())
+            self._users[user['user_id']] = dict(user)
+            self._user_log_rows += 1
+            compact = self._user_log_rows > max(self.USERS_COMPACT_MIN_ROWS,
+                                                self.USERS_COMPACT_RATIO * len(self._users))
+        if compact:
+            self.compact_users()
+
+    def compact_users(self):
+        """Rewrite users.csv with a single row per user."""
+        with self._users_lock:
+            _write_csv_atomic(self.users_file, USER_FIELDS, self._users.values())
+            self._user_log_rows = len(self._users)
+
+    def _load_states(self) -> Dict[str, str]:
+        """Read user_state.csv the first time it is needed. Call with _states_lock held."""
+        if self._states is None:
+            _truncate_partial_line(self.state_file)
+            with open(self.state_file, 'r', newline='') as f:
+                rows = list(csv.DictReader(f))
+            self._states = {}
+            for row in rows:
+                if row['data']:
+                    self._states[row['user_id']] = row['data']
+                else:
+                    self._states.pop(row['user_id'], None)
+            self._state_log_rows = len(rows)
+        return self._states
+
+    def load_user_state(self, user_id: str) -> Optional[str]:
+        with self._states_lock:
+            return self._load_states().get(user_id)
+
+    def save_user_states(self, states: Dict[str, Optional[str]]):
+        with self._states_lock:
+            saved = self._load_states()
+            with open(self.state_file, 'a', newline='') as f:
+                csv.writer(f).writerows((user_id, data or '') for user_id, data in states.items())
+            for user_id, data in states.items():
+                if data:
+                    saved[user_id] = data
+                else:
+                    saved.pop(user_id, None)
+            self._state_log_rows += len(states)
+            if self._state_log_rows > max(self.USERS_COMPACT_MIN_ROWS, self.USERS_COMPACT_RATIO * len(saved)):
+                _write_csv_atomic(self.state_file, USER_STATE_FIELDS,
+                                  ({'user_id': user_id, 'data': data} for user_id, data in saved.items()))
+                self._state_log_rows = len(saved)
+
+    def load_boards(self) -> List[Dict]:
+        boards, _ = _read_csv(self.boards_file, BOARD_DEFAULTS)
+        with self._boards_lock:
+            self._boards = {board['chat_id']: dict(board) for board in boards}
+        return boards
+
+    def save_board(self, chat_id: str, message_id: str, room_id: str):
+        # Boards change rarely, so the whole (small) file is rewritten
+        with self._boards_lock:
+            self._boards[chat_id] = {'chat_id': chat_id, 'message_id': message_id, 'room_id': room_id}
+            _write_csv_atomic(self.boards_file, BOARD_FIELDS, self._boards.values())
+
+    def delete_board(self, chat_id: str):
+        with self._boards_lock:
+            if self._boards.pop(chat_id, None):
+                _write_csv_atomic(self.boards_file, BOARD_FIELDS, self._boards.values())
+
+def _table_exists(conn: sqlite3.Connection, table: str) -> bool:
+    query = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?"
+    return conn.execute(query, (table,)).fetchone() is not None
+
+def _add_missing_columns(conn: sqlite3.Connection, table: str, defaults: Dict[str, str]):
+    """Add columns introduced after the table was created."""
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    for field, default in defaults.items():
+        if field not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {field} TEXT NOT NULL DEFAULT '{default}'")
+
+class SQLiteMachineStorage(MachineStorage):
+    """
+    Stores a room's machines and their event history in a SQLite database in WAL mode.
+    Startup (init, load_machines) uses a short-lived connection; the connection for
+    saves and history reads is opened on first use and kept, so its statement cache is
+    reused, and rooms that are never written don't keep files open.
+    """
+
+    UPSERT_MACHINE = (
+        "INSERT INTO machines (machine_id, machine_type, status, user_id, username, code, end_time, finished_at, "
+        "version) "
+        "VALUES (:machine_id, :machine_type, :status, :user_id, :username, :code, :end_time, :finished_at, :version) "
+        "ON CONFLICT(machine_id) DO UPDATE SET machine_type = excluded.machine_type, "
+        "status = excluded.status, user_id = excluded.user_id, username = excluded.username, "
+        "code = excluded.code, end_time = excluded.end_time, finished_at = excluded.finished_at, "
+        "version = excluded.version"
+    )
+    ADD_MACHINE = (
+        "INSERT OR IGNORE INTO machines (machine_id, machine_type, status, user_id, username, code, end_time, "
+        "finished_at, version) "
+        "VALUES (:machine_id, :machine_type, :status, :user_id, :username, :code, :end_time, :finished_at, :version)"
+    )
+    INSERT_EVENT = (
+        "INSERT INTO machine_events (time, event, machine_id, user_id, username, code, end_time) "
+        "VALUES (:time, :event, :machine_id, :user_id, :username, :code, :end_time)"
+    )
+
+    def __init__(self, database_file: str, import_from: Optional[CSVMachineStorage] = None):
+        self.database_file = database_file
+        # CSV files to import when the database is first created, if they exist
+        self.import_from = import_from
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.database_file, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _connection(self) -> sqlite3.Connection:
+        """The kept connection, opened if needed. Call with _lock held."""
+        if self._conn is None:
+            self._conn = self._connect()
+        return self._conn
+
+    def init(self, machines: List[Dict]):
+        with self._lock:
+            conn = self._connect()
+            try:
+                conn.execute("PRAGMA journal_mode=WAL")
+                with conn:
+                    created = not _table_exists(conn, 'machines')
+                    conn.executescript("""
+                        CREATE TABLE IF NOT EXISTS machines (
+                            machine_id TEXT PRIMARY KEY,
+                            machine_type TEXT NOT NULL,
+                            status TEXT NOT NULL,
+                            user_id TEXT NOT NULL DEFAULT '',
+                            username TEXT NOT NULL DEFAULT '',
+                            code TEXT NOT NULL DEFAULT '',
+                            end_time TEXT NOT NULL DEFAULT '',
+                            finished_at TEXT NOT NULL DEFAULT '',
+                            version TEXT NOT NULL DEFAULT '0'
+                        );
+                        CREATE INDEX IF NOT EXISTS machines_code ON machines (code);
+                        CREATE INDEX IF NOT EXISTS machines_status ON machines (status);
+                        CREATE TABLE IF NOT EXISTS machine_events (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            time TEXT NOT NULL,
+                            event TEXT NOT NULL,
+                            machine_id TEXT NOT NULL,
+                            user_id TEXT NOT NULL DEFAULT '',
+                            username TEXT NOT NULL DEFAULT '',
+                            code TEXT NOT NULL DEFAULT '',
+                            end_time TEXT NOT NULL DEFAULT ''
+                        );
+                        CREATE INDEX IF NOT EXISTS machine_events_machine ON machine_events (machine_id);
+                    """)
+                    _add_missing_columns(conn, 'machines', MACHINE_DEFAULTS)
+                    if created:
+                        self._import_csv(conn)
+                    conn.executemany(self.ADD_MACHINE, machines)
+            finally:
+                conn.close()
+
+    def _import_csv(self, conn: sqlite3.Connection):
+        """Import existing CSV files into a new database."""
+        csv_storage = self.import_from
+        if csv_storage and os.path.exists(csv_storage.machines_file):
+            machines = csv_storage.load_machines()
+            conn.executemany(self.UPSERT_MACHINE, machines)
+            conn.executemany(self.INSERT_EVENT, csv_storage.load_history())
+            print(f"📦 Imported {len(machines)} machines from CSV into {self.database_file}")
+
+    def load_machines(self) -> List[Dict]:
+        with self._lock:
+            conn = self._connect()
+            try:
+                return [dict(row) for row in conn.execute("SELECT * FROM machines ORDER BY rowid")]
+            finally:
+                conn.close()
+
+    def save_machines(self, machines: List[Dict], events: List[Dict]):
+        changed_ids = {event['machine_id'] for event in events}
+        rows = [m for m in machines if m['machine_id'] in changed_ids]
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.executemany(self.INSERT_EVENT, events)
+                conn.executemany(self.UPSERT_MACHINE, rows)
+
+    def load_history(self, machine_id: Optional[str] = None, limit: Optional[int] = None) -> List[Dict]:
+        query = "SELECT time, event, machine_id, user_id, username, code, end_time FROM machine_events"
+        params = []
+        if machine_id:
+            query += " WHERE machine_id = ?"
+            params.append(machine_id)
+        query += " ORDER BY id DESC"
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self._lock:
+            rows = [dict(row) for row in self._connection().execute(query, params)]
+        return rows[::-1]
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+class SQLiteStorage(Storage):
+    """Stores users and live status boards in a SQLite database in WAL mode."""
+
+    UPSERT_USER = (
+        "INSERT INTO users (user_id, username, subscribed, topics, quiet_hours, room) "
+        "VALUES (:user_id, :username, :subscribed, :topics, :quiet_hours, :room) "
+        "ON CONFLICT(user_id) DO UPDATE SET username = excluded.username, subscribed = excluded.subscribed, "
+        "topics = excluded.topics, quiet_hours = excluded.quiet_hours, room = excluded.room"
+    )
+    UPSERT_BOARD = (
+        "INSERT INTO live_boards (chat_id, message_id, room_id) VALUES (:chat_id, :message_id, :room_id) "
+        "ON CONFLICT(chat_id) DO UPDATE SET message_id = excluded.message_id, room_id = excluded.room_id"
+    )
+
+    def __init__(self, database_file: str, import_from: Optional[CSVStorage] = None):
+        self.database_file = database_file
+        # CSV files to import when the database is first created, if they exist
+        self.import_from = import_from
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(database_file, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+
+    def init(self):
+        with self._lock, self._conn:
+            created = not _table_exists(self._conn, 'users')
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id TEXT PRIMARY KEY,
+                    username TEXT NOT NULL,
+                    subscribed TEXT NOT NULL,
+                    topics TEXT NOT NULL DEFAULT 'all',
+                    quiet_hours TEXT NOT NULL DEFAULT '',
+                    room TEXT NOT NULL DEFAULT ''
+                );
+                CREATE TABLE IF NOT EXISTS user_state (
+                    user_id TEXT PRIMARY KEY,
+                    data TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS live_boards (
+                    chat_id TEXT PRIMARY KEY,
+                    message_id TEXT NOT NULL,
+                    room_id TEXT NOT NULL DEFAULT ''
+                );
+            """)
+            _add_missing_columns(self._conn, 'users', USER_DEFAULTS)
+            _add_missing_columns(self._conn, 'live_boards', BOARD_DEFAULTS)
+            if created:
+                self._import_csv()
+
+    def _import_csv(self):
+        """Import existing CSV files into a new database."""
+        csv_storage = self.import_from
+        if csv_storage and os.path.exists(csv_storage.users_file):
+            users = csv_storage.load_users()
+            self._conn.executemany(self.UPSERT_USER, users)
+            print(f"📦 Imported {len(users)} users from CSV")
+
+        if csv_storage and os.path.exists(csv_storage.boards_file):
+            self._conn.executemany(self.UPSERT_BOARD, csv_storage.load_boards())
+
+    def load_users(self) -> List[Dict]:
+        with self._lock:
+            return [dict(row) for row in self._conn.execute("SELECT * FROM users ORDER BY rowid")]
+
+    def save_user(self, user: Dict):
+        with self._lock, self._conn:
+            self._conn.execute(self.UPSERT_USER, user)
+
+    def load_user_state(self, user_id: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM user_state WHERE user_id = ?", (user_id,)).fetchone()
+            return row['data'] if row else None
+
+    def save_user_states(self, states: Dict[str, Optional[str]]):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO user_state (user_id, data) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+                [(user_id, data) for user_id, data in states.items() if data]
+            )
+            self._conn.executemany(
+                "DELETE FROM user_state WHERE user_id = ?",
+                [(user_id,) for user_id, data in states.items() if not data]
+            )
+
+    def load_boards(self) -> List[Dict]:
+        with self._lock:
+            return [dict(row) for row in self._conn.execute("SELECT * FROM live_boards")]
+
+    def save_board(self, chat_id: str, message_id: str, room_id: str):
+        with self._lock, self._conn:
+            self._conn.execute(self.UPSERT_BOARD, {'chat_id': chat_id, 'message_id': message_id, 'room_id': room_id})
+
+    def delete_board(self, chat_id: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM live_boards WHERE chat_id = ?", (chat_id,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,100 @@
+import asyncio
+import threading
+
+import pytest
+
+import async_data_manager as adm
+import data_manager as dm
+
+# How long a call that shouldn't wait on the blocked write may take
+TIMEOUT = 2
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    """Fresh CSV storage in a scratch directory."""
+    monkeypatch.chdir(tmp_path)
+    dm.init_storage('csv')
+    yield
+    dm.close_storage()
+
+def block(monkeypatch, target, name: str):
+    """Make target.name wait until the returned release event is set; started is set once it is called."""
+    started = threading.Event()
+    release = threading.Event()
+    original = getattr(target, name)
+
+    def blocked(*args, **kwargs):
+        started.set()
+        # Bounded, so a regression fails the test instead of hanging it
+        release.wait(TIMEOUT * 5)
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(target, name, blocked)
+    return started, release
+
+async def wait_started(started: threading.Event):
+    assert await asyncio.get_running_loop().run_in_executor(None, started.wait, TIMEOUT)
+
+def test_updates_proceed_while_user_write_is_in_flight(storage, monkeypatch):
+    started, release = block(monkeypatch, dm._storage, 'save_user')
+
+    async def scenario():
+        write = asyncio.ensure_future(adm.add_user(1, "slow"))
+        await wait_started(started)
+        try:
+            status = await asyncio.wait_for(adm.get_status_message(dm.DEFAULT_ROOM), TIMEOUT)
+            code = await asyncio.wait_for(adm.use_machine(dm.DEFAULT_ROOM, 'WM2', 2, "other", 45), TIMEOUT)
+            assert not write.done()
+        finally:
+            release.set()
+        await write
+        return status, code
+
+    status, code = asyncio.run(scenario())
+    assert "Status" in status
+    assert code is not None
+    assert dm.get_user(1) is not None
+
+def test_updates_proceed_while_machine_write_is_in_flight(storage, monkeypatch):
+    room = dm._rooms[dm.DEFAULT_ROOM]
+    started, release = block(monkeypatch, room.storage, 'save_machines')
+
+    async def scenario():
+        assert await adm.use_machine(dm.DEFAULT_ROOM, 'WM1', 1, "first", 45)
+        write = asyncio.get_running_loop().run_in_executor(adm._executor, dm.flush_machines, dm.DEFAULT_ROOM)
+        await wait_started(started)
+        try:
+            status = await asyncio.wait_for(adm.get_status_message(dm.DEFAULT_ROOM), TIMEOUT)
+            code = await asyncio.wait_for(adm.use_machine(dm.DEFAULT_ROOM, 'WM2', 2, "second", 45), TIMEOUT)
+            assert not write.done()
+        finally:
+            release.set()
+        await write
+        return status, code
+
+    status, code = asyncio.run(scenario())
+    assert "WM1" in status
+    assert code is not None
+    assert dm.get_machine_by_id(dm.DEFAULT_ROOM, 'WM2')['status'] == 'in_use'
+
+def test_updates_proceed_while_many_user_writes_are_in_flight(storage, monkeypatch):
+    started, release = block(monkeypatch, dm._storage, 'save_user')
+
+    async def scenario():
+        # More than the shared pool has threads, e.g. a burst of /starts
+        writes = [asyncio.ensure_future(adm.add_user(user_id, f"user{user_id}")) for user_id in range(1, 7)]
+        await wait_started(started)
+        try:
+            code = await asyncio.wait_for(adm.use_machine(dm.DEFAULT_ROOM, 'WM1', 10, "other", 45), TIMEOUT)
+            collected = await asyncio.wait_for(adm.collect_by_code(code), TIMEOUT)
+            history = await asyncio.wait_for(adm.get_machine_history(dm.DEFAULT_ROOM), TIMEOUT)
+            assert not any(write.done() for write in writes)
+        finally:
+            release.set()
+        await asyncio.gather(*writes)
+        return collected, history
+
+    collected, history = asyncio.run(scenario())
+    assert collected[0]
+    assert isinstance(history, list)
+    assert all(dm.get_user(user_id) is not None for user_id in range(1, 7))
@@ -0,0 +1,109 @@
+import math
+import threading
+import time
+from typing import Callable, Dict, Hashable, List, Optional, Set
+
+# Every time-based event (finish notifications, "not collected yet" reminders,
+# releases of abandoned machines and waitlist claim expiries) is a timer in one hashed
+# timing wheel. A single repeating job advances the wheel, instead of the job queue
+# holding one job per reservation.
+
+TICK_SECONDS = 1.0
+# One turn of the wheel covers WHEEL_SLOTS ticks (an hour); timers further out stay in
+# their slot until the turn they are due in
+WHEEL_SLOTS = 3600
+
+class Timer:
+    __slots__ = ('group', 'kind', 'tick', 'when', 'callback', 'data')
+
+    def __init__(self, group: Hashable, kind: str, tick: int, when: float, callback: Callable, data):
+        self.group = group
+        self.kind = kind
+        self.tick = tick
+        self.when = when
+        self.callback = callback
+        self.data = data
+
+class TimingWheel:
+    """
+    Hashed timing wheel. Timers are kept in the slot of the tick they are due in, so
+    scheduling and cancelling are O(1) and each tick only looks at one slot. A timer is
+    identified by (group, kind), e.g. ((room_id, machine_id), 'finish'); scheduling the
+    same one again replaces it. Safe to use from several threads.
+    """
+
+    def __init__(self, tick_seconds: float = TICK_SECONDS, slots: int = WHEEL_SLOTS, now: Optional[float] = None):
+        self.tick_seconds = tick_seconds
+        self.slots: List[Dict[tuple, Timer]] = [{} for _ in range(slots)]
+        self.current_tick = int((time.time() if now is None else now) // tick_seconds)
+        self._timers: Dict[tuple, Timer] = {}
+        self._groups: Dict[Hashable, Set[str]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._timers)
+
+    def schedule(self, group: Hashable, kind: str, when: float, callback: Callable, data=None):
+        """
+        Set a timer for time when (a time.time() value), replacing the group's timer of
+        this kind. Once due, advance() hands it to the caller, which runs the callback.
+        """
+        with self._lock:
+            # Rounded up, so timers never fire early; timers already due fire on the next tick
+            tick = max(math.ceil(when / self.tick_seconds), self.current_tick + 1)
+            self._remove((group, kind))
+            timer = Timer(group, kind, tick, when, callback, data)
+            self.slots[tick % len(self.slots)][(group, kind)] = timer
+            self._timers[(group, kind)] = timer
+            self._groups.setdefault(group, set()).add(kind)
+
+    def cancel(self, group: Hashable, kind: Optional[str] = None) -> int:
+        """Cancel a group's timer of the given kind, or all of its timers. Returns how many were cancelled."""
+        with self._lock:
+            kinds = [kind] if kind else list(self._groups.get(group, ()))
+            return sum(self._remove((group, k)) for k in kinds)
+
+    def _remove(self, key: tuple) -> bool:
+        """Call with _lock held."""
+        timer = self._timers.pop(key, None)
+        if timer is None:
+            return False
+        del self.slots[timer.tick % len(self.slots)][key]
+        kinds = self._groups[timer.group]
+        kinds.discard(timer.kind)
+        if not kinds:
+            del self._groups[timer.group]
+        return True
+
+    def advance(self, now: Optional[float] = None) -> List[Timer]:
+        """Move the wheel up to now and return the timers that became due (removed from the wheel), earliest first."""
+        target = int((time.time() if now is None else now) // self.tick_seconds)
+        due = []
+        with self._lock:
+            if target <= self.current_tick:
+                return due
+            # After a long pause, one pass over every slot is enough
+            first = max(self.current_tick + 1, target - len(self.slots) + 1)
+            for tick in range(first, target + 1):
+                slot = self.slots[tick % len(self.slots)]
+                for key in [key for key, timer in slot.items() if timer.tick <= target]:
+                    due.append(self._timers[key])
+                    self._remove(key)
+            self.current_tick = target
+        due.sort(key=lambda timer: timer.when)
+        return due
+
+_wheel = TimingWheel()
+
+def schedule(group: Hashable, kind: str, when: float, callback: Callable, data=None):
+    _wheel.schedule(group, kind, when, callback, data)
+
+def cancel(group: Hashable, kind: Optional[str] = None) -> int:
+    return _wheel.cancel(group, kind)
+
+def advance(now: Optional[float] = None) -> List[Timer]:
+    return _wheel.advance(now)
+
+def pending() -> int:
+    """How many timers are waiting."""
+    return len(_wheel)